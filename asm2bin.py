@@ -5,10 +5,26 @@ Author: Mark Liffiton
 """
 
 import argparse
+import glob
+import hashlib
+import json
 import os
 import sys
+import time
+from collections.abc import Callable
+from typing import TYPE_CHECKING, Any
 
-from assembler import Assembler, AssemblerException
+from assembler import (
+    BACKENDS,
+    ISA,
+    Assembler,
+    AssemblerException,
+    IncrementalAssembler,
+    Stats,
+)
+
+if TYPE_CHECKING:
+    from buildcache import BuildCache
 
 
 def printmsg(msgtuple: tuple[str, str], color: str = "0;36") -> None:
@@ -28,7 +44,263 @@ def parse_swap(s: str) -> tuple[str, int, int]:
         )
 
 
-def main() -> None:
+def default_outfiles(asmfile: str, format: str) -> list[str]:
+    """Output files for an assembly source file if none are given."""
+    basename = os.path.splitext(asmfile)[0]
+    if format == "256sim" or format == "logisim":
+        return [f"{basename}.bin"]
+    else:
+        return [f"{basename}.{i}.bin" for i in (0, 1)]
+
+
+def expand_sources(sources: list[str]) -> list[str]:
+    """Expand directories (to the .asm files in them) and glob patterns in
+    a list of sources.  Other names are kept as given, even if missing.
+    """
+    files = []
+    for source in sources:
+        if os.path.isdir(source):
+            files.extend(sorted(glob.glob(os.path.join(source, "*.asm"))))
+        elif glob.has_magic(source):
+            files.extend(sorted(glob.glob(source)))
+        else:
+            files.append(source)
+    return files
+
+
+# ISA, backend, build cache, and whether to collect stats, used by
+# assemble_one() and set once per worker by init_worker()
+worker_isa: ISA | None = None
+worker_backend = "plan"
+worker_cache: "BuildCache | None" = None
+worker_stats = False
+
+
+def init_worker(
+    isa: ISA, backend: str, cache: "BuildCache | None" = None, stats: bool = False
+) -> None:
+    global worker_isa, worker_backend, worker_cache, worker_stats
+    worker_isa = isa
+    worker_backend = backend
+    worker_cache = cache
+    worker_stats = stats
+
+
+def assemble_one(asmfile: str, format: str, stream: bool) -> dict[str, Any]:
+    """Assemble one file of a batch, returning its summary."""
+    assert worker_isa is not None
+    messages: list[tuple[str, Any]] = []
+    a = Assembler(
+        worker_isa,
+        info_callback=messages.append,
+        backend=worker_backend,
+        stats=worker_stats,
+    )
+    outfiles = default_outfiles(asmfile, format)
+    summary: dict[str, Any] = {
+        "source": asmfile,
+        "outputs": [],
+        "words": None,
+        "warnings": [],
+        "error": None,
+    }
+
+    start = time.perf_counter()
+    try:
+        if not os.path.exists(asmfile):
+            raise AssemblerException("File not found", asmfile)
+        summary["words"] = a.assemble_file(
+            asmfile, format, outfiles, stream=stream, listing=False, cache=worker_cache
+        )
+        summary["outputs"] = outfiles
+    except AssemblerException as e:
+        summary["error"] = {
+            "msg": e.msg,
+            "data": str(e.data) if e.data is not None else None,
+            "lineno": e.lineno,
+            "inst": e.inst,
+        }
+    except OSError as e:
+        summary["error"] = {
+            "msg": e.strerror,
+            "data": e.filename,
+            "lineno": None,
+            "inst": None,
+        }
+    summary["seconds"] = round(time.perf_counter() - start, 6)
+
+    summary["warnings"] = [
+        {"msg": msg, "data": str(data)}
+        for msg, data in messages
+        if msg not in ("Assembling", "Generated", "Stats", "Encoding cache")
+    ]
+    if a.stats is not None:
+        summary["stats"] = a.stats.as_dict()
+    return summary
+
+
+def build_cache(configfile: str) -> "BuildCache":
+    # imported only for --cache, so asm2bin.py runs with just assembler.py
+    from buildcache import BuildCache
+
+    return BuildCache.for_config(configfile)
+
+
+def run_batch(
+    isa: ISA,
+    sources: list[str],
+    format: str,
+    args: argparse.Namespace,
+    cache: "BuildCache | None" = None,
+) -> dict[str, Any]:
+    """Assemble many source files, each in a worker process with the ISA
+    loaded once per worker (or all in this process if jobs is 1)."""
+    asmfiles = expand_sources(sources)
+    start = time.perf_counter()
+    jobs = [(asmfile, format, args.stream) for asmfile in asmfiles]
+    if args.jobs > 1:
+        import concurrent.futures
+
+        with concurrent.futures.ProcessPoolExecutor(
+            args.jobs, initializer=init_worker, initargs=(isa, args.backend, cache, args.stats)
+        ) as executor:
+            results = list(executor.map(assemble_one, *zip(*jobs)))
+    else:
+        init_worker(isa, args.backend, cache, args.stats)
+        results = [assemble_one(*job) for job in jobs]
+
+    return {
+        "config": args.configfile,
+        "format": format,
+        "jobs": args.jobs,
+        "files": results,
+        "assembled": sum(result["error"] is None for result in results),
+        "failed": sum(result["error"] is not None for result in results),
+        "seconds": round(time.perf_counter() - start, 6),
+    }
+
+
+def print_summary(summary: dict[str, Any]) -> None:
+    """Print the results of a batch as a single run would have."""
+    for result in summary["files"]:
+        printmsg(("Assembling", result["source"]))
+        for warning in result["warnings"]:
+            printmsg((warning["msg"], warning["data"]))
+        error = result["error"]
+        if error:
+            printmsg(
+                (
+                    error["msg"],
+                    "{}\nLine {}: {}".format(error["data"], error["lineno"], error["inst"]),
+                ),
+                color="1;31",
+            )
+        else:
+            printmsg(("Generated", ", ".join(result["outputs"])))
+
+
+def file_digest(path: str) -> str | None:
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def watch(
+    args: argparse.Namespace,
+    format: str,
+    outfiles: list[str],
+    load_isa: Callable[[str], ISA],
+) -> None:
+    """Assemble the source again whenever it or the config changes, until
+    interrupted.  Unchanged lines reuse their previous work (see
+    IncrementalAssembler), and the ISA is only reloaded if the config's
+    contents changed.
+    """
+    from filewatch import FileWatcher
+
+    def load() -> IncrementalAssembler:
+        isa = load_isa(args.configfile)
+        if args.swap:
+            for kind, v1, v2 in args.swap:
+                isa = isa.with_swap(kind, v1, v2)
+        a = Assembler(isa, info_callback=printmsg, backend=args.backend)
+        return IncrementalAssembler(a, fresh_runs=True)
+
+    def build(inc: IncrementalAssembler) -> None:
+        a = inc.assembler
+        if args.stats:
+            a.stats = Stats()
+        a.report_inf("Assembling", args.asmfile)
+        try:
+            with open(args.asmfile) as f:
+                lines = f.readlines()
+            instructions = inc.assemble_lines(lines)
+        except OSError as e:
+            printmsg((e.strerror or "Error", args.asmfile), color="1;31")
+            return
+        except AssemblerException as e:
+            printmsg(
+                (e.msg, "{}\nLine {}: {}".format(e.data, e.lineno, e.inst)),
+                color="1;31",
+            )
+            return
+        with a.phase("listing"):
+            if args.listing_file:
+                with open(args.listing_file, "w") as f:
+                    a.write_listing(f, instructions)
+            elif args.listing:
+                print(a.prettyprint_assembly(instructions))
+        a.write_image(format, outfiles, [inst.binary for inst in instructions])
+        a.report_inf("Generated", ", ".join(outfiles))
+        a.report_stats()
+
+    config_path = os.path.abspath(args.configfile)
+    config = file_digest(config_path)
+    inc = load()
+    watcher = FileWatcher([args.asmfile, config_path])
+    try:
+        start = time.perf_counter()
+        while True:
+            build(inc)
+            printmsg(
+                (
+                    "Watching",
+                    "{}, {} ({:.1f} ms; {}; Ctrl-C to stop)".format(
+                        args.asmfile,
+                        args.configfile,
+                        (time.perf_counter() - start) * 1000,
+                        watcher.method,
+                    ),
+                )
+            )
+            changed = watcher.wait()
+            start = time.perf_counter()
+            if config_path in changed:
+                digest = file_digest(config_path)
+                if digest is not None and digest != config:
+                    try:
+                        inc = load()
+                    except Exception as e:  # e.g., a config only partly edited
+                        printmsg(("Error loading config", str(e)), color="1;31")
+                        continue
+                    config = digest
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+class RunLocally(Exception):
+    """Raised by main() in a daemon for a run that could occupy it
+    indefinitely (--watch or --batch), which the client should do itself."""
+
+
+def main(load_isa: Callable[[str], ISA] = ISA.from_file, daemon: bool = False) -> None:
+    """Run the command line in sys.argv.  load_isa loads the ISA for a
+    config file (e.g., from a cache of already loaded ISAs).  In a daemon,
+    --watch and --batch raise RunLocally instead of running."""
     parser = argparse.ArgumentParser(description="CS256 ISA Assembler")
 
     group = parser.add_mutually_exclusive_group()
@@ -49,12 +321,95 @@ def main() -> None:
         help="Value swap in format KIND:V1,V2 (e.g., 'r:1,2')",
     )
 
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="plan",
+        help="Instruction encoding backend: 'plan', 'codegen' (generated "
+        "Python), or 'numpy' (whole programs at once, if NumPy is installed; "
+        "not with --stream) (default: plan)",
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Assemble in a single pass straight to the output files (no listing)",
+    )
+
+    parser.add_argument(
+        "--no-listing",
+        dest="listing",
+        action="store_false",
+        help="Only produce the output files (do not print a listing)",
+    )
+
+    parser.add_argument(
+        "--listing",
+        dest="listing_file",
+        metavar="FILE",
+        help="Write the listing to FILE (e.g., prog.lst) instead of printing it",
+    )
+
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Assemble many sources (files, directories, or globs) to their "
+        "default output files, reporting a JSON summary (no listings)",
+    )
+
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="With --batch, number of worker processes (default: 1)",
+    )
+
+    parser.add_argument(
+        "--summary",
+        default="-",
+        metavar="FILE",
+        help="With --batch, write the JSON summary to FILE and print "
+        "messages as usual (default: '-', print just the summary)",
+    )
+
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Reuse the outputs of an identical earlier build, leaving "
+        "up-to-date output files untouched (not with --stream)",
+    )
+
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Report the time taken by each phase and counts of lines, "
+        "instructions, labels, cache hits, and bytes written",
+    )
+
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Assemble again whenever the source or config file changes",
+    )
+
     parser.add_argument("configfile", help="Assembler config file")
     parser.add_argument("asmfile", help="Assembly source file")
-    parser.add_argument("outfiles", nargs="*", help="Output files")
+    parser.add_argument(
+        "outfiles", nargs="*", help="Output files (with --batch: more sources)"
+    )
 
     args = parser.parse_args()
 
+    if args.watch and (args.batch or args.stream or args.cache):
+        parser.error("--watch cannot be used with --batch, --stream, or --cache")
+    if args.cache and args.stream:
+        parser.error("--cache cannot be used with --stream")
+    if args.listing_file and (args.batch or args.stream or not args.listing):
+        parser.error("--listing cannot be used with --batch, --stream, or --no-listing")
+    if daemon and (args.watch or args.batch):
+        raise RunLocally()
+
     # Determine format
     if args.logisim:
         format = "logisim"
@@ -68,6 +423,23 @@ def main() -> None:
         print("File not found: " + args.configfile, file=sys.stderr)
         sys.exit(1)
 
+    if args.batch:
+        isa = load_isa(args.configfile)
+        if args.swap:
+            for kind, v1, v2 in args.swap:
+                isa = isa.with_swap(kind, v1, v2)
+        cache = build_cache(args.configfile) if args.cache else None
+        summary = run_batch(isa, [args.asmfile, *args.outfiles], format, args, cache)
+        if args.summary == "-":
+            json.dump(summary, sys.stdout, indent=2)
+            print()
+        else:
+            print()  # blank line
+            print_summary(summary)
+            with open(args.summary, "w") as f:
+                json.dump(summary, f, indent=2)
+        sys.exit(1 if summary["failed"] else 0)
+
     if not os.path.exists(args.asmfile):
         print("File not found: " + args.asmfile, file=sys.stderr)
         sys.exit(1)
@@ -76,26 +448,44 @@ def main() -> None:
     if args.outfiles:
         outfiles = args.outfiles
     else:
-        basename = os.path.splitext(args.asmfile)[0]
-        if format == "256sim" or format == "logisim":
-            outfiles = [f"{basename}.bin"]
-        else:
-            outfiles = [f"{basename}.{i}.bin" for i in (0, 1)]
+        outfiles = default_outfiles(args.asmfile, format)
 
     print()  # blank line
 
-    a = Assembler(args.configfile, info_callback=printmsg)
+    if args.watch:
+        watch(args, format, outfiles, load_isa)
+        return
+
+    start = time.perf_counter()
+    isa = load_isa(args.configfile)
+    config_time = time.perf_counter() - start
+
+    a = Assembler(isa, info_callback=printmsg, backend=args.backend, stats=args.stats)
+    if a.stats is not None:
+        a.stats.times["config"] = config_time
 
     if args.swap:
         for kind, v1, v2 in args.swap:
             a.add_swap(kind, v1, v2)
 
+    listing_file = open(args.listing_file, "w") if args.listing_file else None
     try:
-        a.assemble_file(args.asmfile, format, outfiles)
+        a.assemble_file(
+            args.asmfile,
+            format,
+            outfiles,
+            stream=args.stream,
+            listing=args.listing,
+            cache=build_cache(args.configfile) if args.cache else None,
+            listing_file=listing_file,
+        )
     except AssemblerException as e:
         printmsg(
             (e.msg, "{}\nLine {}: {}".format(e.data, e.lineno, e.inst)), color="1;31"
         )
+    finally:
+        if listing_file:
+            listing_file.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+CS256 ISA Assembler: Daemon client
+Author: Mark Liffiton
+
+Runs asm2bin.py with the given arguments in a running asmd.py daemon, which
+keeps configs loaded, to skip most of the startup time of each run.  Output
+and exit status are those of running asm2bin.py directly, which is what
+happens if no daemon is running.
+
+Protocol: the client connects to the daemon's Unix socket and sends its
+stdin, stdout, and stderr file descriptors (so the daemon writes straight
+to them) along with a 4-byte length and a marshalled request dict (argv,
+cwd, env, and stream encodings).  The daemon replies with the exit status
+in ASCII once the run is done, or with "local" for a run it leaves to the
+client (--watch or --batch, which could occupy it indefinitely).
+
+Each side checks that the other is run by the same user before sending
+anything, and only the environment variables asm2bin.py uses are sent.
+"""
+
+# Only builtin modules, to keep startup time to a minimum ("socket" itself
+# imports more than the whole rest of the client).
+import _socket
+import marshal
+import os
+import struct
+import sys
+
+# Environment variables read by asm2bin.py (and so passed to the daemon)
+ENV_VARS = ("ASM256_CACHE_DIR",)
+
+
+def default_socket() -> str:
+    """The daemon's socket: $ASM256_SOCKET, or one per user in
+    $XDG_RUNTIME_DIR (or /tmp)."""
+    return os.environ.get("ASM256_SOCKET") or os.path.join(
+        os.environ.get("XDG_RUNTIME_DIR") or "/tmp", "256asm-{}.sock".format(os.getuid())
+    )
+
+
+def peer_uid(sock: "_socket.socket", path: str) -> int:
+    """The user id of the process at the other end of a connected Unix
+    socket (or, where that is not available, of the socket file's owner)."""
+    if hasattr(_socket, "SO_PEERCRED"):
+        size = struct.calcsize("3i")  # pid, uid, gid
+        creds = sock.getsockopt(_socket.SOL_SOCKET, _socket.SO_PEERCRED, size)
+        return struct.unpack("3i", creds)[1]
+    return os.stat(path).st_uid
+
+
+def run(argv: list[str], path: str) -> int | None:
+    """Run asm2bin.py with argv in the daemon listening at path, returning
+    its exit status (or None if it must be run here instead)."""
+    request = marshal.dumps(
+        {
+            "argv": argv,
+            "cwd": os.getcwd(),
+            "env": {name: os.environ[name] for name in ENV_VARS if name in os.environ},
+            "encoding": [
+                (f.encoding, f.errors) for f in (sys.stdin, sys.stdout, sys.stderr)
+            ],
+        }
+    )
+    data = struct.pack("!I", len(request)) + request
+
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        if peer_uid(sock, path) != os.getuid():
+            # (e.g., someone else bound the socket in /tmp first)
+            raise PermissionError("{} belongs to another user".format(path))
+        sys.stdout.flush()
+        sys.stderr.flush()
+        fds = struct.pack("3i", 0, 1, 2)
+        sent = sock.sendmsg([data], [(_socket.SOL_SOCKET, _socket.SCM_RIGHTS, fds)])
+        if sent < len(data):
+            sock.sendall(data[sent:])
+
+        reply = b""
+        while True:
+            chunk = sock.recv(64)
+            if not chunk:
+                break
+            reply += chunk
+    finally:
+        sock.close()
+    if not reply:
+        raise ConnectionError("daemon closed the connection")
+    if reply == b"local":
+        return None
+    return int(reply)
+
+
+def main() -> None:
+    try:
+        status = run(sys.argv[1:], default_socket())
+    except (FileNotFoundError, ConnectionRefusedError, PermissionError) as e:
+        if isinstance(e, PermissionError):
+            print("asmc: not using daemon: {}".format(e), file=sys.stderr)
+        status = None  # no daemon running (that we can use)
+    except ConnectionError as e:
+        print("asmc: {}".format(e), file=sys.stderr)
+        sys.exit(1)
+    if status is None:
+        # just run it here
+        import asm2bin
+
+        sys.argv[0] = os.path.join(os.path.dirname(sys.argv[0]), "asm2bin.py")
+        asm2bin.main()
+        return
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+CS256 ISA Assembler: Daemon
+Author: Mark Liffiton
+
+Serves asm2bin.py runs for asmc.py clients over a Unix socket (see asmc.py
+for the protocol), keeping each config's ISA loaded between runs.
+"""
+
+import argparse
+import hashlib
+import marshal
+import os
+import select
+import signal
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import traceback
+
+import asm2bin
+from asmc import ENV_VARS, default_socket, peer_uid
+from assembler import ISA
+
+
+class AssemblerDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Runs asm2bin.py for each connection.
+
+    A run changes the process-wide stdio, working directory, environment
+    (just the variables in ENV_VARS), and argv to the client's, so runs are
+    done one at a time.  Runs that could go on indefinitely (--watch and
+    --batch) are left to the client, and a run whose client hangs up while
+    waiting for its turn is dropped.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path: str) -> None:
+        # Loaded ISAs, by config file path: (hash of contents, ISA)
+        self.isas: dict[str, tuple[str, ISA]] = {}
+        self.run_lock = threading.Lock()
+        self.path = path
+        super().__init__(path, RunHandler)
+        os.chmod(path, 0o600)  # clients' files are written with our permissions
+
+    def load_isa(self, configfile: str) -> ISA:
+        """Load the ISA for a config file, reusing the one already loaded
+        if the file has not changed."""
+        path = os.path.realpath(configfile)
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        loaded = self.isas.get(path)
+        if loaded is None or loaded[0] != digest:
+            loaded = (digest, ISA.from_file(path))
+            self.isas[path] = loaded
+        return loaded[1]
+
+    def run(
+        self, request: dict, fds: list[int], conn: socket.socket
+    ) -> int | str | None:
+        """Run asm2bin.py as requested, with stdin, stdout, and stderr on
+        the given file descriptors, returning its exit status, "local" if
+        the client should run it itself, or None if the client hung up on
+        the connection before its turn."""
+        streams = []
+        for fd, mode, (encoding, errors) in zip(fds, "rww", request["encoding"]):
+            # buffered as the interpreter would (stderr is always line buffered)
+            line_buffered = fd == fds[2] or os.isatty(fd)
+            streams.append(
+                open(
+                    fd,
+                    mode,
+                    buffering=1 if line_buffered else -1,
+                    encoding=encoding,
+                    errors=errors,
+                )
+            )
+
+        if not self.wait_turn(conn):
+            for stream in streams:
+                stream.close()
+            return None
+        try:
+            saved = (
+                sys.stdin,
+                sys.stdout,
+                sys.stderr,
+                sys.argv,
+                os.getcwd(),
+                {name: os.environ.get(name) for name in ENV_VARS},
+            )
+            sys.stdin, sys.stdout, sys.stderr = streams
+            sys.argv = ["asm2bin.py", *request["argv"]]
+            try:
+                set_env({name: request["env"].get(name) for name in ENV_VARS})
+                os.chdir(request["cwd"])
+                status = self.call_main()
+            finally:
+                for stream in streams:
+                    try:
+                        stream.close()
+                    except OSError:
+                        pass  # e.g., client's stdout closed early
+                sys.stdin, sys.stdout, sys.stderr, sys.argv = saved[:4]
+                os.chdir(saved[4])
+                set_env(saved[5])
+        finally:
+            self.run_lock.release()
+        return status
+
+    def wait_turn(self, conn: socket.socket) -> bool:
+        """Acquire run_lock, unless the client hangs up on conn first."""
+        while not self.run_lock.acquire(timeout=0.1):
+            if hung_up(conn):
+                return False
+        if hung_up(conn):
+            self.run_lock.release()
+            return False
+        return True
+
+    def call_main(self) -> int | str:
+        """Call asm2bin.main(), giving the exit status the interpreter would
+        (or "local" for a run left to the client)."""
+        try:
+            asm2bin.main(self.load_isa, daemon=True)
+        except asm2bin.RunLocally:
+            return "local"
+        except SystemExit as e:
+            if e.code is None:
+                return 0
+            if isinstance(e.code, int):
+                return e.code
+            print(e.code, file=sys.stderr)
+            return 1
+        except Exception:
+            traceback.print_exc()
+            return 1
+        return 0
+
+
+def hung_up(conn: socket.socket) -> bool:
+    """Whether a client has closed its connection (after its request, a
+    client sends nothing, so any event on the connection means it has)."""
+    poller = select.poll()
+    poller.register(conn, select.POLLIN | select.POLLHUP)
+    return bool(poller.poll(0))
+
+
+def set_env(values: dict[str, str | None]) -> None:
+    """Set environment variables, removing those whose value is None."""
+    for name, value in values.items():
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+
+class RunHandler(socketserver.BaseRequestHandler):
+    request: socket.socket
+    server: AssemblerDaemon
+
+    def handle(self) -> None:
+        if peer_uid(self.request, self.server.path) != os.getuid():
+            return  # only run for our own user (whose files we write)
+        data, fds, _, _ = socket.recv_fds(self.request, 65536, 3)
+        try:
+            if len(fds) != 3:
+                return
+            while len(data) < 4 or len(data) < 4 + struct.unpack("!I", data[:4])[0]:
+                chunk = self.request.recv(65536)
+                if not chunk:
+                    return
+                data += chunk
+            request = marshal.loads(data[4:])
+            status = self.server.run(request, fds, self.request)
+            fds = []  # closed by run()
+            if status is not None:
+                self.request.sendall(str(status).encode())
+        finally:
+            for fd in fds:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="CS256 ISA Assembler daemon")
+    parser.add_argument(
+        "--socket",
+        default=default_socket(),
+        help="Unix socket to listen on (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    if os.path.exists(args.socket):
+        # remove it if left behind by a daemon that is no longer running
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(args.socket)
+        except ConnectionRefusedError:
+            os.remove(args.socket)
+        else:
+            print("Already running: " + args.socket, file=sys.stderr)
+            sys.exit(1)
+        finally:
+            probe.close()
+
+    server = AssemblerDaemon(args.socket)
+    # exit cleanly (removing the socket) when killed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Listening on {}".format(args.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,42 +4,118 @@ CS256 ISA Assembler: Web interface
 Author: Mark Liffiton
 """
 
+import argparse
+import hashlib
+import json
+import multiprocessing
 import os
 import sys
+import tempfile
+import threading
 import zipfile
+from collections import OrderedDict
+from typing import Any
+from urllib.parse import parse_qs
 
-from assembler import Assembler, AssemblerException
-from bottle import post, request, route, run, static_file, template
+from assembler import ISA, AssemblerException, AssemblerPool, Stats
+from bottle import (
+    HTTPResponse,
+    post,
+    request,
+    route,
+    run,
+    server_names,
+    static_file,
+    template,
+)
+from webserver import SERVERS
 
-# Parse/check commandline arguments
-if len(sys.argv) < 2:
-    print("Usage: asmweb.py CONFIGFILE [PORT]", file=sys.stderr)
-    sys.exit(1)
 
-configfile = sys.argv[1]
-if not os.path.exists(configfile):
-    print("File not found: {}".format(configfile), file=sys.stderr)
-    print("Usage: asmweb.py CONFIGFILE [PORT]", file=sys.stderr)
-    sys.exit(1)
-assembler = Assembler(configfile)
+class ResultCache:
+    """A thread-safe cache of the most recent max_entries /assemble/
+    responses, keyed by a hash of the ISA and the posted source.
 
-zipfilename = "{}2bin.zip".format(assembler.name.replace(" ", ""))
+    A whole class often posts the same sample file or starter code, so this
+    saves assembling it again for each of them.
 
-if len(sys.argv) > 2:
-    port = int(sys.argv[2])
-else:
-    port = 8080
+    Its hits, misses, and number of entries are counted in counts, shared
+    memory that can be given to the caches of other processes (e.g., those
+    of a process executor), which then count into it as well, so that any
+    of them reports the totals.
+    """
+
+    HITS, MISSES, ENTRIES = range(3)  # indexes into counts
+
+    def __init__(self, max_entries: int, counts: Any = None) -> None:
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, bytes] = OrderedDict()
+        self.lock = threading.Lock()
+        self.counts = counts if counts is not None else multiprocessing.Array("q", 3)
+
+    def count(self, index: int, n: int = 1) -> None:
+        with self.counts.get_lock():
+            self.counts[index] += n
+
+    @staticmethod
+    def key(isa: ISA, source: bytes) -> str:
+        h = hashlib.sha256()
+        h.update(repr((isa.config_hash, isa.swaps)).encode())
+        h.update(b"\0")
+        h.update(source)
+        return h.hexdigest()
+
+    def get(self, key: str) -> bytes | None:
+        with self.lock:
+            content = self.entries.get(key)
+            if content is None:
+                self.count(self.MISSES)
+            else:
+                self.count(self.HITS)
+                self.entries.move_to_end(key)
+            return content
+
+    def put(self, key: str, content: bytes) -> None:
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            size = len(self.entries)
+            self.entries[key] = content
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            self.count(self.ENTRIES, len(self.entries) - size)
+
+    def as_dict(self) -> dict:
+        with self.counts.get_lock():
+            hits, misses, entries = self.counts[:]
+        lookups = hits + misses
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,  # (per process)
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+
+# Set by load()
+isa: ISA
+# Successive posts are usually small edits of the same code, so each request
+# reuses an assembler (and its work) from the pool
+pool: AssemblerPool
+results: ResultCache
+zipfilename: str
 
 
 @route("/")
 def index():
     return template(
         "index",
-        name=assembler.name,
+        name=isa.name,
         zipfilename=zipfilename,
-        samplefile=assembler.samplefile,
-        instructions=assembler.instructions,
-        reg_prefix=assembler.reg_prefix,
+        samplefile=isa.samplefile,
+        instructions=isa.instructions,
+        reg_prefix=isa.reg_prefix,
     )
 
 
@@ -56,47 +132,240 @@ def static(filename):
 @route("/dl/<filename>")
 def download(filename):
     assert filename == zipfilename
-    with zipfile.ZipFile(zipfilename, "w") as zip:
+    # write a new file and move it into place, in case of concurrent downloads
+    fd, tmpname = tempfile.mkstemp(dir=".", suffix=".zip.tmp")
+    with os.fdopen(fd, "wb") as f, zipfile.ZipFile(f, "w") as zip:
         zip.write("asm2bin.py")
         zip.write("assembler.py")
-        zip.write(assembler.configfile)
-        zip.write(assembler.samplefile)
+        zip.write("buildcache.py")  # for --cache
+        zip.write("filewatch.py")  # for --watch
+        zip.write(str(isa.configfile))
+        zip.write(isa.samplefile)
         zip.write("README.md")
+    os.chmod(tmpname, 0o644)
+    os.replace(tmpname, zipfilename)
     return static_file(zipfilename, root=".", download=True)
 
 
+@route("/cache/")
+def cache_stats():
+    # (totals over the caches of all of a multi-process server's processes)
+    return results.as_dict()
+
+
 @post("/assemble/")
 def assemble():
-    asm = request.body.read().decode()
+    # timings and counts only if asked for (/assemble/?stats=1)
+    stats = bool(request.query.get("stats"))
+    if_none_match = request.get_header("If-None-Match", "")
+    status, headers, content = assemble_response(
+        request.body.read(), stats, if_none_match
+    )
+    return HTTPResponse(content, status, headers)
+
+
+def assemble_json(
+    body: bytes, query: str, headers: dict[str, str]
+) -> tuple[int, list[tuple[str, str]], bytes]:
+    """The response to a post to /assemble/, for servers that handle it
+    themselves (see webserver.AsyncServer)."""
+    stats = bool(parse_qs(query).get("stats", [""])[0])
+    return assemble_response(body, stats, headers.get("if-none-match", ""))
+
+
+def assemble_response(
+    body: bytes, stats: bool = False, if_none_match: str = ""
+) -> tuple[int, list[tuple[str, str]], bytes]:
+    """The status, headers, and JSON body of the response to a post of body.
+
+    The ETag is the result cache's key for the source, so a client that
+    already has the response for it (one of the tags in if_none_match) gets
+    304 Not Modified without anything being assembled.  X-Cache says whether
+    the body came from the result cache: "HIT", "MISS", or "BYPASS" for
+    requests with stats, which are never cached (and have no ETag).
+    """
+    if stats:
+        content = json.dumps(assemble_source(body.decode(), stats)).encode()
+        headers = [("Content-Type", "application/json"), ("X-Cache", "BYPASS")]
+        return 200, headers, content
+
+    key = ResultCache.key(isa, body)
+    etag = '"{}"'.format(key)
+    if etag_matches(if_none_match, etag):
+        return 304, [("ETag", etag)], b""
+
+    cached = results.get(key)
+    if cached is not None:
+        content, cache_status = cached, "HIT"
+    else:
+        content = json.dumps(assemble_source(body.decode())).encode()
+        results.put(key, content)
+        cache_status = "MISS"
+    headers = [
+        ("Content-Type", "application/json"),
+        ("ETag", etag),
+        ("X-Cache", cache_status),
+    ]
+    return 200, headers, content
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Whether an If-None-Match header matches etag (with the weak comparison
+    it calls for)."""
+    if if_none_match.strip() == "*":
+        return True
+    tags = (tag.strip().removeprefix("W/") for tag in if_none_match.split(","))
+    return etag in tags
+
+
+def assemble_source(asm: str, stats: bool = False) -> dict[str, Any]:
     lines = asm.split("\n")
 
-    out = {}
+    out: dict[str, Any] = {}
     out["messages"] = []
 
-    assembler.register_info_callback(out["messages"].append)
+    with pool.get() as incremental:
+        assembler = incremental.assembler
+        assembler.register_info_callback(out["messages"].append)
+        assembler.stats = Stats() if stats else None
 
-    try:
-        instructions = assembler.assemble_lines(lines)
-        out["code"] = assembler.prettyprint_assembly(instructions, colorize=True)
-        binary = [inst.binary for inst in instructions]
-        out["bin"] = " ".join("{:04x}".format(word) for word in binary)
+        try:
+            instructions = incremental.assemble_lines(lines)
+            with assembler.phase("listing"):
+                out["code"] = assembler.prettyprint_assembly(instructions, colorize=True)
+            binary = [inst.binary for inst in instructions]
+            out["bin"] = " ".join("{:04x}".format(word) for word in binary)
 
-        upperbytes = []
-        lowerbytes = []
-        for word in binary:
-            upperbytes.append(word // 256)
-            lowerbytes.append(word % 256)
+            upperbytes = []
+            lowerbytes = []
+            for word in binary:
+                upperbytes.append(word // 256)
+                lowerbytes.append(word % 256)
 
-        out["upper"] = " ".join("{:02x}".format(byte) for byte in upperbytes)
-        out["lower"] = " ".join("{:02x}".format(byte) for byte in lowerbytes)
+            out["upper"] = " ".join("{:02x}".format(byte) for byte in upperbytes)
+            out["lower"] = " ".join("{:02x}".format(byte) for byte in lowerbytes)
 
-    except AssemblerException as e:
-        out["error"] = {
-            key: getattr(e, key) for key in ["msg", "data", "lineno", "inst"]
-        }
+        except AssemblerException as e:
+            out["error"] = {
+                key: getattr(e, key) for key in ["msg", "data", "lineno", "inst"]
+            }
+
+        if assembler.stats is not None:
+            out["stats"] = assembler.stats.as_dict()
 
     return out
 
 
-# Launch the server for external access
-run(host="0.0.0.0", port=port)
+def load(
+    configfile: str, workers: int, cache_size: int = 256, counts: Any = None
+) -> None:
+    """Load the config, with a pool of workers assemblers for it and an
+    empty result cache (counting into counts, if given; see ResultCache).
+    With no workers, this process does no assembling (e.g., it just passes
+    posts to a process executor), so it gets no pool."""
+    global isa, pool, results, zipfilename
+    isa = ISA.from_file(configfile)
+    results = ResultCache(cache_size, counts)
+    if workers:
+        # fresh_runs, so identical posts get identical responses (see ResultCache)
+        pool = AssemblerPool(isa, workers, fresh_runs=True)
+        with pool.get():
+            pass  # create one now (to be shared by any forked server workers)
+    zipfilename = "{}2bin.zip".format(isa.name.replace(" ", ""))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="CS256 ISA Assembler web interface")
+    parser.add_argument("configfile", help="Assembler config file")
+    parser.add_argument(
+        "port", nargs="?", type=int, default=8080, help="Port (default: 8080)"
+    )
+    parser.add_argument(
+        "--server",
+        choices=[*SERVERS, *server_names],
+        default="threaded",
+        metavar="SERVER",
+        help="Server backend: 'threaded' (a thread per connection, with "
+        "keep-alive), 'prefork' (worker processes), 'async' (asyncio, "
+        "assembling in an executor), 'wsgiref' (one request at a time), or "
+        "any other installed Bottle server backend (default: threaded)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Maximum number of assemblies run at once (default: 8)",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=0,
+        help="With --server prefork, number of worker processes "
+        "(default: one per CPU)",
+    )
+    parser.add_argument(
+        "--max-requests",
+        type=int,
+        default=0,
+        help="With --server prefork, replace each worker process after this "
+        "many requests (default: 0, never)",
+    )
+    parser.add_argument(
+        "--executor",
+        choices=["thread", "process"],
+        default="thread",
+        help="With --server async, run assemblies in --workers threads or "
+        "processes (default: thread)",
+    )
+    parser.add_argument(
+        "--queue",
+        type=int,
+        default=64,
+        help="With --server async, number of assemblies allowed to wait for a "
+        "worker before answering 503 (default: 64)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=256,
+        help="Number of /assemble/ responses kept for identical posts "
+        "(default: 256; 0 to disable)",
+    )
+    args = parser.parse_args()
+
+    if not os.path.exists(args.configfile):
+        print("File not found: {}".format(args.configfile), file=sys.stderr)
+        parser.print_usage(sys.stderr)
+        sys.exit(1)
+
+    # With a process executor, its processes do all of the assembling, each
+    # with its own cache (counting into this process's, for /cache/).
+    process_executor = args.server == "async" and args.executor == "process"
+    load(args.configfile, 0 if process_executor else args.workers, args.cache_size)
+
+    options = {}
+    if args.server == "prefork":
+        options = {
+            "workers": args.processes,
+            "max_requests": args.max_requests,
+            # SIGHUP reloads the config and restarts the workers
+            "reload": lambda: load(args.configfile, args.workers, args.cache_size),
+        }
+    elif args.server == "async":
+        options = {
+            "offload": {("POST", "/assemble/"): assemble_json},
+            "executor": args.executor,
+            "workers": args.workers,
+            "queue": args.queue,
+            # each process assembles one request at a time
+            "initializer": load,
+            "initargs": (args.configfile, 1, args.cache_size, results.counts),
+        }
+
+    # Launch the server for external access
+    server = SERVERS.get(args.server, args.server)
+    run(host="0.0.0.0", port=args.port, server=server, **options)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,16 +3,42 @@ CS256 ISA Assembler
 Author: Mark Liffiton
 """
 
-from collections import defaultdict
-from collections.abc import Callable, Sequence
-import configparser
+from array import array
+from collections import OrderedDict, defaultdict
+from collections.abc import Callable, Iterable, Iterator, Mapping, Sequence
+import hashlib
+import io
+import marshal
+import os
 import re
-from dataclasses import dataclass
+import sys
+import time
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from dataclasses import dataclass, field
 from pathlib import PurePath
-from typing import Any, TypeAlias, TypedDict
+from types import MappingProxyType
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    BinaryIO,
+    NoReturn,
+    TextIO,
+    TypeAlias,
+    TypedDict,
+)
+
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
+    import numpy as np
+
+    from buildcache import BuildCache
 
 # Type aliases
 InfoCallback: TypeAlias = Callable[[tuple[str, str]], None]
+# a generated encoder function, for the "codegen" backend: (assembler,
+# operands, pc) -> binary word
+Encoder: TypeAlias = Callable[["Assembler", list[str], int], int]
 
 
 class AssemblerException(Exception):
@@ -40,8 +66,8 @@ class AssemblerException(Exception):
 class ISAInfo(TypedDict, total=False):
     opcode: int
     funccode: int
-    parts: list[str]
-    sizes: list[int]
+    parts: Sequence[str]
+    sizes: Sequence[int]
     args: int
     tweak: str
 
@@ -50,6 +76,9 @@ class ISAInfo(TypedDict, total=False):
 class ASMLine:
     text: str
     lineno: int
+    # filled in by the lexer: mnemonic and operands (commas stripped)
+    mnemonic: str | None = None
+    operands: list[str] | None = None
 
 
 @dataclass
@@ -69,93 +98,992 @@ class Instruction:
     binary: int
 
 
-class Assembler:
-    """Assembles CS256 assembly code into machine code following definitions
-    given in the specified config file."""
+@dataclass(frozen=True)
+class FieldPlan:
+    """Precomputed encoding details for one field of an instruction."""
+
+    kind: str
+    size: int
+    argpos: int | None  # index into the instruction's text parts, if any
+    const: int | None  # fixed value for fields w/o arguments (opcode, etc.)
+    color: str
+    signed: bool  # 2's complement range check and wrap ('i', 'l')
+    unsigned: bool  # absolute range check ('j')
+    lo: float  # allowed range for checked fields: lo <= val < hi
+    hi: float
+    mask: int
+
+
+@dataclass(frozen=True)
+class EncodingPlan:
+    """Everything needed to encode one instruction, computed once per ISA.
+
+    fields are in the order written in the config; order gives the order
+    in which they are placed in the final binary (after any tweak), with
+    shifts giving each placed field's shift amount.
+    """
+
+    inst_info: ISAInfo
+    args: int
+    uses_labels: bool  # encoding depends on labels (and maybe pc)
+    fields: tuple[FieldPlan, ...]
+    order: tuple[int, ...]
+    shifts: tuple[int, ...]
+    swaps: tuple[tuple[int, ...] | None, ...]  # per field, from the ISA's swaps
+
+
+class InstructionTable(Sequence[Instruction]):
+    """Compact assembled program: one array column per attribute rather than
+    an Instruction object per word.
+
+    Columns hold each instruction's binary word, source line number,
+    mnemonic (as an index into mnemonics), and the offset of its field
+    values (in config order) in the packed values column.  Text, colors,
+    and binary strings are derived on demand: indexing or iterating yields
+    Instruction views built from the columns and the source lines, so a
+    table can be passed to prettyprint_assembly().
+    """
 
     def __init__(
-        self, configfile: str | PurePath, info_callback: InfoCallback | None = None
+        self, assembler: "Assembler", lines: Sequence[str], word_bits: int
     ) -> None:
-        # manipulate configfile and samplefile as PurePath objects
-        self.configfile = PurePath(configfile)
+        self.isa = assembler.isa
+        self.lines = lines  # source lines, for recovering instruction text
+        self.labels = assembler.labels
+        self.mnemonics = list(self.isa.plans)
+        self.mnemonic_ids = {inst: i for i, inst in enumerate(self.mnemonics)}
+        field_bits = max(
+            (fp.size for plan in self.isa.plans.values() for fp in plan.fields),
+            default=0,
+        )
+        self.words = array(self.typecode(word_bits))
+        self.linenos = array("I")
+        self.mnemonic_index = array("H")
+        self.field_starts = array("I")
+        self.field_values = array(self.typecode(field_bits))
+
+    @staticmethod
+    def typecode(bits: int) -> str:
+        """Smallest array typecode holding unsigned values of the given width
+        ("L" is 8 bytes on LP64 platforms, so "I" is used for 32 bits)."""
+        return "H" if bits <= 16 else "I" if bits <= 32 else "Q"
+
+    def append(self, lineno: int, mnemonic: str, vals: list[int], word: int) -> None:
+        self.words.append(word)
+        self.linenos.append(lineno)
+        self.mnemonic_index.append(self.mnemonic_ids[mnemonic])
+        self.field_starts.append(len(self.field_values))
+        self.field_values.extend(vals)
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def __getitem__(self, index):  # type: ignore[override]
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return self.view(index)
+
+    def __iter__(self) -> Iterator[Instruction]:
+        for i in range(len(self)):
+            yield self.view(i)
+
+    def view(self, index: int) -> Instruction:
+        """Build an Instruction for the given instruction index."""
+        isa = self.isa
+        if index < 0:
+            index += len(self)
+        lineno = self.linenos[index]
+        text = isa.clean_line(self.lines[lineno - 1]).replace(",", " ")
+        match = isa.lexer.match(text)
+        assert match and match["mnemonic"]
+        line = isa.make_asmline(text, lineno, match)
+        args = [line.mnemonic, *line.operands]  # type: ignore[misc]
+
+        plan = isa.plans[self.mnemonics[self.mnemonic_index[index]]]
+        start = self.field_starts[index]
+        vals = self.field_values[start : start + len(plan.fields)]
+        fields = [
+            BinaryField(
+                fp.kind, fp.size, bin(val)[2:].rjust(fp.size, "0"), val, fp.color
+            )
+            for fp, val in zip(plan.fields, vals)
+        ]
+
+        return Instruction(
+            line,
+            list(zip(args, isa.palette)),  # zip() stops at end of shortest
+            [fields[i] for i in plan.order],
+            self.words[index],
+        )
+
+
+class ImageWriter:
+    """Writes instruction words to memory image file(s) as they are produced.
+
+    Every word occupies a fixed position in its file(s), so a word written
+    earlier (e.g., a placeholder for an unresolved label) can be patched.
+    Formats match Assembler.output_bin(), output_sim_bin(), and
+    output_logisim_img() for words of up to 16 bits; wider words are padded
+    to a fixed number of hex digits.
+
+    Words go to temporary files beside the output files, which replace them
+    only on finish(), so a failed assembly leaves any earlier images intact.
+    """
+
+    def __init__(self, format: str, outfiles: list[str], word_bits: int = 16) -> None:
+        self.format = format
+        self.count = 0
+        self.digits = max(4, -(-word_bits // 4))  # hex digits per word
+        self.header = b""
+        self.outfiles = image_files(format, outfiles)
+        self.tmpfiles = [
+            "{}.{}.tmp".format(name, os.getpid()) for name in self.outfiles
+        ]
+        self.files: list[BinaryIO] = []
+        try:
+            for name in self.tmpfiles:
+                self.files.append(open(name, "wb"))
+        except BaseException:
+            self.discard()
+            raise
+        if format == "bin":
+            self.stride = 1
+        else:
+            # text formats written as bytes so positions are exact offsets
+            self.stride = self.digits + 1  # word plus separator
+            if format == "logisim":
+                # header required by Logisim to read memory image files
+                self.header = b"v2.0 raw\n"
+                self.files[0].write(self.header)
+
+    def encode(self, word: int, first: bool) -> list[bytes]:
+        """Bytes to write for a word in each file."""
+        if self.format == "bin":
+            return [bytes((word % 256,)), bytes((word // 256,))]
+        sep = b"" if first else b" "
+        return [sep + b"%0*x" % (self.digits, word)]
+
+    def write(self, word: int) -> None:
+        """Append the next word."""
+        for f, data in zip(self.files, self.encode(word, self.count == 0)):
+            f.write(data)
+        self.count += 1
+
+    def patch(self, pc: int, word: int) -> None:
+        """Overwrite the already-written word at address pc."""
+        # (for text formats, this skips the separator written before the word)
+        offset = len(self.header) + pc * self.stride
+        for f, data in zip(self.files, self.encode(word, True)):
+            f.seek(offset)
+            f.write(data)
+            f.seek(0, 2)
+
+    def finish(self) -> None:
+        """Complete the images and move them into place."""
+        try:
+            if self.format == "256sim":
+                self.files[0].write(b"\n")
+            for f in self.files:
+                f.close()
+            for tmpname, name in zip(self.tmpfiles, self.outfiles):
+                os.replace(tmpname, name)
+        except BaseException:
+            self.discard()
+            raise
+
+    def discard(self) -> None:
+        """Abandon the images, leaving the output files as they were."""
+        for f in self.files:
+            f.close()
+        for tmpname in self.tmpfiles:
+            try:
+                os.remove(tmpname)
+            except OSError:
+                pass  # never created, or already moved into place
+
+
+def image_files(format: str, outfiles: list[str]) -> list[str]:
+    """The output files actually written for an image in the given format."""
+    return outfiles[: 2 if format == "bin" else 1]
+
+
+@dataclass
+class Stats:
+    """Timings (in seconds) of the phases of assembling and counts of what
+    was processed, collected by an Assembler created with stats=True.
+
+    Phases: config (loading it), first_pass (lexing), labels (placing them
+    at their addresses), encode (including resolving label operands),
+    listing, and output (writing image files), or stream for all of
+    assemble_stream()'s single pass.  Counts: lines, instructions, labels,
+    cache_hits and cache_misses (encoding cache), bytes (written to image
+    files), plus reused
+    (instructions, for an IncrementalAssembler) and cached_builds (see
+    assemble_file_cached()).
+    """
+
+    times: dict[str, float] = field(default_factory=dict)
+    counts: dict[str, int] = field(default_factory=dict)
+
+    @contextmanager
+    def phase(
+        self, name: str, cache_counts: Callable[[], tuple[int, int]] | None = None
+    ) -> Iterator[None]:
+        """Time a phase, also counting the cache hits and misses during it if
+        given a function returning the numbers so far."""
+        hits, misses = cache_counts() if cache_counts else (0, 0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - start
+            if cache_counts:
+                new_hits, new_misses = cache_counts()
+                self.count("cache_hits", new_hits - hits)
+                self.count("cache_misses", new_misses - misses)
+
+    def count(self, name: str, n: int) -> None:
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def as_dict(self) -> dict[str, dict[str, Any]]:
+        return {"times": dict(self.times), "counts": dict(self.counts)}
+
+    def __str__(self) -> str:
+        times = ", ".join(
+            "{} {:.2f} ms".format(name, secs * 1000) for name, secs in self.times.items()
+        )
+        counts = ", ".join("{} {}".format(name, n) for name, n in self.counts.items())
+        return "; ".join(part for part in (times, counts) if part)
+
+
+# Used by Assembler.phase() when not collecting stats
+NO_STATS = nullcontext()
+
+
+# Encoding backends: "plan" walks each instruction's EncodingPlan;
+# "codegen" runs straight-line Python generated from the plans;
+# "numpy" encodes whole programs at once with NumPy arrays in
+# assemble_words() (and otherwise acts like "plan").
+BACKENDS = ("plan", "codegen", "numpy")
+
+
+# Bump whenever the contents of parsed config data change.
+ISA_CACHE_VERSION = 1
+
+
+def parse_config(text: str) -> dict[str, Any]:
+    """Parse the text of a config file into plain data (dicts, lists, strs,
+    and ints) describing the ISA, with each instruction's field sizes and
+    argument count worked out.
+    """
+    import configparser  # only needed on a cache miss
+
+    config = configparser.ConfigParser()
+    config.read_string(text)
+
+    isa: dict[str, Any] = {}
+    isa["name"] = config.get("general", "name")
+    isa["inst_size"] = config.getint("general", "inst_size")
+    isa["max_reg"] = config.getint("general", "max_reg")
+    isa["reg_prefix"] = config.get("general", "reg_prefix")
+    isa["samplefile"] = config.get("general", "samplefile")
+
+    isa["special_regs"] = {x: int(y) for x, y in config.items("special_regs")}
+
+    field_sizes = {x: int(y) for x, y in config.items("field_sizes")}
+    isa["field_sizes"] = field_sizes
+
+    instructions: dict[str, ISAInfo] = defaultdict(lambda: ISAInfo())
+    for inst, opcode in config.items("instruction_opcodes"):
+        instructions[inst]["opcode"] = int(opcode)
+    for inst, parts_str in config.items("instruction_parts"):
+        instructions[inst]["parts"] = list(parts_str)
+    if "instruction_tweaks" in config:
+        for inst, tweak in config.items("instruction_tweaks"):
+            instructions[inst]["tweak"] = tweak
+
+    if "instruction_funccodes" in config.sections():
+        for inst, funccode in config.items("instruction_funccodes"):
+            instructions[inst]["funccode"] = int(funccode)
+
+    # create sizes and arg counts for each instruction
+    # modifies instruction dictionaries within instructions
+    for inst_info in instructions.values():
+        # figure out number of required arguments to instruction
+        # (count number of parts of types that require arguments)
+        parts = list(inst_info["parts"])
+        inst_info["args"] = sum(parts.count(c) for c in "rilj")
+
+        # figure out sizes (for shift amounts)
+        sizes = []
+        rem = isa["inst_size"]  # remaining bits
+        for c in parts:
+            if c in field_sizes:
+                sizes.append(field_sizes[c])
+                rem -= field_sizes[c]
+        if rem:
+            # any extra gets all remaining bits
+            parts.append("x")
+            sizes.append(rem)
+
+        inst_info["parts"] = parts
+        inst_info["sizes"] = sizes
+
+    isa["instructions"] = dict(instructions)
+
+    # One pattern classifies a cleaned line as an instruction (mnemonic
+    # followed by whitespace) or a label; anything else is invalid.
+    isa["lexer"] = r"(?P<mnemonic>{})\s(?P<operands>.*)|(?P<label>[a-z][a-z0-9]*):$".format(
+        "|".join(re.escape(inst) for inst in instructions)
+    )
+
+    return isa
+
+
+def isa_cache_prefix(configfile: PurePath) -> str:
+    """The start of the cache file names for a config file: in
+    $ASM256_CACHE_DIR if set, else __pycache__ beside it, named for the
+    file and a hash of its absolute path (so same-named configs elsewhere
+    sharing a cache directory do not collide).
+    """
+    cachedir = os.environ.get("ASM256_CACHE_DIR") or os.path.join(
+        configfile.parent, "__pycache__"
+    )
+    path_hash = hashlib.sha256(os.path.abspath(configfile).encode()).hexdigest()
+    return os.path.join(cachedir, "{}.{}.".format(configfile.stem, path_hash[:8]))
+
+
+def isa_cache_file(configfile: PurePath, digest: str) -> str:
+    """Where to cache the parsed data for a config file with the given
+    content hash (see isa_cache_prefix())."""
+    return "{}{}.isa".format(isa_cache_prefix(configfile), digest[:16])
+
+
+def freeze(value: Any) -> Any:
+    """A read-only copy of parsed config data: its dicts as mappingproxies
+    and its lists as tuples, all the way down."""
+    if isinstance(value, Mapping):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value: Any) -> Any:
+    """A plain (e.g., picklable) copy of frozen config data (see freeze())."""
+    if isinstance(value, Mapping):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+
+def load_config(configfile: PurePath, use_cache: bool = True) -> dict[str, Any]:
+    """Load the parsed data for a config file (see parse_config()).
+
+    Parsed data is cached on disk, keyed by a hash of the config file's
+    contents, so a warm start reads one small marshal file and never
+    imports configparser.
+    """
+    with open(configfile, "rb") as f:
+        raw = f.read()
+    digest = hashlib.sha256(raw).hexdigest()
+    cachefile = isa_cache_file(configfile, digest)
+
+    if use_cache:
+        try:
+            with open(cachefile, "rb") as f:
+                isa = marshal.load(f)
+            if (
+                isa.get("version") == ISA_CACHE_VERSION
+                and isa.get("hash") == digest
+            ):
+                return isa
+        except (OSError, EOFError, ValueError, TypeError, AttributeError):
+            pass  # missing or unreadable: parse and rewrite it
+
+    isa = parse_config(raw.decode("utf-8"))
+    isa["version"] = ISA_CACHE_VERSION
+    isa["hash"] = digest
+
+    if use_cache:
+        try:
+            cachedir = os.path.dirname(cachefile)
+            os.makedirs(cachedir, exist_ok=True)
+            # remove entries for previous versions of this config (only), and
+            # any for its name in the old format (stem.digest.isa), which
+            # nothing reads any more
+            prefix = os.path.basename(isa_cache_prefix(configfile))
+            old_format = re.compile(
+                r"{}\.[0-9a-f]{{16}}\.isa$".format(re.escape(configfile.stem))
+            )
+            for name in os.listdir(cachedir):
+                if (name.startswith(prefix) and name.endswith(".isa")) or old_format.match(
+                    name
+                ):
+                    try:
+                        os.remove(os.path.join(cachedir, name))
+                    except FileNotFoundError:
+                        pass  # (removed by another process at the same time)
+            tmpfile = "{}.{}.tmp".format(cachefile, os.getpid())
+            with open(tmpfile, "wb") as f:
+                marshal.dump(isa, f)
+            os.replace(tmpfile, cachefile)
+        except OSError:
+            pass  # e.g., read-only directory: just don't cache
+
+    return isa
+
+
+class ISA:
+    """An instruction set: everything parsed from a config file, plus any
+    value swaps, with each instruction's encoding plan precomputed.
+
+    ISA objects are immutable and hashable, so one can be shared by any
+    number of threads and assemblies at once; all per-run state (labels,
+    messages, etc.) lives in the Assembler doing the run.  with_swap()
+    returns a new ISA rather than changing this one.  The parsed config
+    data is copied read-only (see freeze()), so the mappings and sequences
+    within it (e.g., each instruction's ISAInfo) cannot be changed either.
+    """
+
+    __slots__ = (
+        "configfile",
+        "data",
+        "swaps",
+        "config_hash",
+        "name",
+        "inst_size",
+        "max_reg",
+        "reg_prefix",
+        "samplefile",
+        "special_regs",
+        "field_sizes",
+        "instructions",
+        "value_swaps",
+        "palette",
+        "registers",
+        "reg_regex",
+        "imm_regex",
+        "lexer",
+        "label_regex",
+        "plans",
+        "key",
+        "_encoders",
+    )
+
+    configfile: PurePath
+    data: Mapping[str, Any]
+    swaps: tuple[tuple[str, int, int], ...]
+    config_hash: str
+    name: str
+    inst_size: int
+    max_reg: int
+    reg_prefix: str
+    samplefile: PurePath
+    special_regs: Mapping[str, int]
+    field_sizes: Mapping[str, int]
+    instructions: Mapping[str, ISAInfo]
+    value_swaps: Mapping[str, Mapping[int, int]]
+    palette: tuple[str, ...]
+    registers: Mapping[str, int]
+    reg_regex: re.Pattern[str]
+    imm_regex: re.Pattern[str]
+    lexer: re.Pattern[str]
+    label_regex: re.Pattern[str]
+    plans: Mapping[str, EncodingPlan]
+    key: str
+    _encoders: "dict[str, Encoder] | None"
 
-        config = configparser.ConfigParser()
-        config.read(self.configfile, encoding="utf-8")
+    def __init__(
+        self,
+        configfile: str | PurePath,
+        data: Mapping[str, Any],
+        swaps: tuple[tuple[str, int, int], ...] = (),
+    ) -> None:
+        """Build an ISA from parsed config data (see load_config())."""
+        init = object.__setattr__.__get__(self)  # bypass immutability
 
-        self.name = config.get("general", "name")
-        self.inst_size = config.getint("general", "inst_size")
-        self.max_reg = config.getint("general", "max_reg")
-        self.reg_prefix = config.get("general", "reg_prefix")
+        # manipulate configfile and samplefile as PurePath objects
+        init("configfile", PurePath(configfile))
+        data = freeze(data)
+        init("data", data)
+        init("swaps", tuple(swaps))
+        init("config_hash", data["hash"])
+
+        init("name", data["name"])
+        init("inst_size", data["inst_size"])
+        init("max_reg", data["max_reg"])
+        init("reg_prefix", data["reg_prefix"])
         # Samplefile should be in same directory as config file
-        self.samplefile = self.configfile.parent / config.get("general", "samplefile")
+        init("samplefile", self.configfile.parent / data["samplefile"])
+
+        init("special_regs", data["special_regs"])
+        init("field_sizes", data["field_sizes"])
+        init("instructions", data["instructions"])
+
+        value_swaps: dict[str, dict[int, int]] = defaultdict(dict)
+        for kind, v1, v2 in self.swaps:
+            value_swaps[kind][v1] = v2
+            value_swaps[kind][v2] = v1
+        init(
+            "value_swaps",
+            MappingProxyType({k: MappingProxyType(v) for k, v in value_swaps.items()}),
+        )
 
-        self.special_regs = {x: int(y) for x, y in config.items("special_regs")}
+        init(
+            "palette",
+            (
+                "#6D993B",
+                "#A37238",
+                "#AC4548",
+                "#6048A3",
+                "#449599",
+            ),
+        )
 
-        self.field_sizes = {x: int(y) for x, y in config.items("field_sizes")}
+        # Every canonical register spelling, plus special registers, mapped to its index
+        registers = {
+            "{}{}".format(self.reg_prefix, i): i for i in range(self.max_reg + 1)
+        }
+        registers.update(self.special_regs)
+        init("registers", MappingProxyType(registers))
+        init("reg_regex", re.compile(r"{}\d+$".format(re.escape(self.reg_prefix))))
+        init("imm_regex", re.compile(r"-?\d+$|-?0x[a-fA-F0-9]+$|-?0b[01]+$"))
+        # One pattern classifies a cleaned line as an instruction (mnemonic
+        # followed by whitespace) or a label; anything else is invalid.
+        init("lexer", re.compile(data["lexer"], re.DOTALL))
+        init("label_regex", re.compile("[a-z][a-z0-9]*$"))
+
+        init(
+            "plans",
+            MappingProxyType(
+                {
+                    inst: self.compile_plan(inst_info)
+                    for inst, inst_info in self.instructions.items()
+                }
+            ),
+        )
 
-        self.instructions: dict[str, ISAInfo] = defaultdict(lambda: ISAInfo())
-        for inst, opcode in config.items("instruction_opcodes"):
-            self.instructions[inst]["opcode"] = int(opcode)
-        for inst, parts_str in config.items("instruction_parts"):
-            self.instructions[inst]["parts"] = list(parts_str)
-        if "instruction_tweaks" in config:
-            for inst, tweak in config.items("instruction_tweaks"):
-                self.instructions[inst]["tweak"] = tweak
+        # identifies the ISA (config contents and swaps), e.g. for cache keys
+        init(
+            "key",
+            hashlib.sha256(
+                "{}|{}|{}".format(self.configfile, self.config_hash, self.swaps).encode()
+            ).hexdigest(),
+        )
 
-        if "instruction_funccodes" in config.sections():
-            for inst, funccode in config.items("instruction_funccodes"):
-                self.instructions[inst]["funccode"] = int(funccode)
+        # generated encoder functions for the "codegen" backend (built lazily)
+        init("_encoders", None)
 
-        self.report_commas = True
-        self.value_swaps: dict[str, dict[int, int]] = defaultdict(dict)
-
-        self.palette = [
-            "#6D993B",
-            "#A37238",
-            "#AC4548",
-            "#6048A3",
-            "#449599",
-        ]
+    @classmethod
+    def from_file(cls, configfile: str | PurePath, use_cache: bool = True) -> "ISA":
+        """Load the ISA defined by a config file."""
+        return cls(configfile, load_config(PurePath(configfile), use_cache))
+
+    def with_swap(self, kind: str, v1: int, v2: int) -> "ISA":
+        """Return a copy of this ISA that also swaps values v1 and v2 in
+        fields of the given kind."""
+        return ISA(self.configfile, self.data, (*self.swaps, (kind, v1, v2)))
+
+    def __setattr__(self, name: str, value: Any) -> NoReturn:
+        raise AttributeError(f"ISA objects are immutable (setting {name})")
+
+    def __delattr__(self, name: str) -> NoReturn:
+        raise AttributeError(f"ISA objects are immutable (deleting {name})")
+
+    def __reduce__(self) -> tuple[Any, ...]:
+        # pickle just the parsed data; everything else is rebuilt
+        return (ISA, (str(self.configfile), thaw(self.data), self.swaps))
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, ISA):
+            return NotImplemented
+        return self.key == other.key
+
+    def __hash__(self) -> int:
+        return hash(self.key)
+
+    def __repr__(self) -> str:
+        return "ISA({!r}, {!r}, swaps={!r})".format(
+            self.name, str(self.configfile), self.swaps
+        )
+
+    def compile_plan(self, inst_info: ISAInfo) -> EncodingPlan:
+        """Precompute the fields, range bounds, and layout of one instruction."""
+        fields = []
+        argpos = 0  # text part consumed by each field that takes one
+        for kind, size in zip(inst_info["parts"], inst_info["sizes"]):
+            pos = None
+            color = "#999999"
+            if kind in ["o", "r", "l", "j", "i"]:
+                pos = argpos
+                argpos += 1
+                color = self.palette[pos % len(self.palette)]
+
+            const = None
+            if kind == "o":
+                const = inst_info.get("opcode")
+            elif kind == "f":
+                const = inst_info.get("funccode")
+            elif kind in "xyz":
+                const = 0
+
+            signed = kind in ["l", "i"]
+            unsigned = kind == "j"
+            if signed:
+                lo, hi = -(2 ** (size - 1)), 2 ** (size - 1)
+            else:
+                lo, hi = 0, 2**size
+            fields.append(
+                FieldPlan(
+                    kind, size, pos, const, color, signed, unsigned, lo, hi, 2**size - 1
+                )
+            )
+
+        order = list(range(len(fields)))
+        if inst_info.get("tweak") == "flip_args":
+            # Swap first and second operand
+            # e.g., for a Store instruction w/ dest address written first but it needs to be 2nd reg.
+            # e.g., for a Branch instruction where we want the immediate to be first in the encoding but we write the label second in the assembly instruction
+            order[1], order[2] = order[2], order[1]
+        elif inst_info.get("tweak") == "dupe1to3":
+            # Copy first operand to third (end) position
+            # e.g., for a Store instruction w/ src data as first arg, but ISA typically has src reg as second and third args
+            order.append(order[1])
+
+        # shift amount for each placed field is the total size of all fields after it
+        shifts = []
+        total = 0
+        for i in reversed(order):
+            shifts.append(total)
+            total += fields[i].size
+        shifts.reverse()
+
+        return EncodingPlan(
+            inst_info,
+            inst_info["args"],
+            any(fp.kind in ["l", "j"] for fp in fields),
+            tuple(fields),
+            tuple(order),
+            tuple(shifts),
+            tuple(self.compile_swap_table(fp.kind) for fp in fields),
+        )
+
+    def compile_swap_table(self, kind: str) -> tuple[int, ...] | None:
+        """Build a lookup array for a field kind, if it has value swaps."""
+        swaps = self.value_swaps.get(kind)
+        if not swaps:
+            return None
+        table = list(range(max(max(swaps), 0) + 1))
+        for v1, v2 in swaps.items():
+            if v1 >= 0:
+                table[v1] = v2
+        return tuple(table)
+
+    @staticmethod
+    def clean_line(line: str) -> str:
+        """Strip comments and surrounding whitespace and lowercase a line."""
+        return line.partition("#")[0].lower().strip()
+
+    @staticmethod
+    def make_asmline(text: str, lineno: int, match: re.Match[str]) -> ASMLine:
+        """Build an ASMLine from a lexer match for an instruction."""
+        return ASMLine(
+            text=text,
+            lineno=lineno,
+            mnemonic=match["mnemonic"],
+            operands=match["operands"].replace(",", " ").split(),
+        )
+
+    def lex_instruction(self, line: ASMLine) -> None:
+        """Fill in the mnemonic and operands of an instruction's ASMLine."""
+        match = self.lexer.match(line.text)
+        assert match and match["mnemonic"]
+        lexed = self.make_asmline(line.text, line.lineno, match)
+        line.mnemonic, line.operands = lexed.mnemonic, lexed.operands
+
+    def combine_fields(self, plan: EncodingPlan, vals: list[int]) -> int:
+        """Build the final binary by shifting and summing each placed field."""
+        instruction_bin = 0
+        for i, shift in zip(plan.order, plan.shifts):
+            instruction_bin += vals[i] << shift
+        return instruction_bin
+
+    def decode_fields(self, plan: EncodingPlan, instruction_bin: int) -> list[int]:
+        """Recover each field's value (in config order) from a binary word."""
+        vals = [0] * len(plan.fields)
+        for i, shift in zip(plan.order, plan.shifts):
+            vals[i] = (instruction_bin >> shift) & plan.fields[i].mask
+        return vals
+
+    def word_bits(self) -> int:
+        """Size in bits of the widest encoded instruction."""
+        return max(
+            (sum(plan.fields[i].size for i in plan.order) for plan in self.plans.values()),
+            default=self.inst_size,
+        )
+
+    def get_encoders(self) -> "dict[str, Encoder]":
+        """Return the generated encoder functions, compiling them if needed."""
+        encoders = self._encoders
+        if encoders is None:
+            namespace: dict[str, Any] = {"registers": self.registers}
+            source = self.generate_encoder_source()
+            exec(compile(source, f"<256asm encoders: {self.name}>", "exec"), namespace)
+            encoders = {inst: namespace[f"encode_{i}"] for i, inst in enumerate(self.plans)}
+            # (a benign race: threads compiling at once build identical functions)
+            object.__setattr__(self, "_encoders", encoders)
+        return encoders
+
+    def generate_encoder_source(self) -> str:
+        """Generate straight-line Python source with one encoder function per
+        instruction.  Each takes the Assembler doing the run (for its labels
+        and error reporting), the operand strings, and pc and returns the
+        binary word, with range checks, swaps, and tweaks inlined.
+        """
+        src = []
+        for i, (inst, plan) in enumerate(self.plans.items()):
+            src.append(f"def encode_{i}(asm, ops, pc):  # {inst}")
+            const = 0  # sum of all fields known ahead of time
+            names: list[str | int] = []  # variable name or constant per field
+            for k, (fp, swap) in enumerate(zip(plan.fields, plan.swaps)):
+                v = f"v{k}"
+                if fp.kind in "rilj":
+                    assert fp.argpos is not None
+                    a = f"ops[{fp.argpos - 1}]"
+                    if fp.kind == "r":
+                        src.append(f"    {v} = registers.get({a})")
+                        src.append(f"    if {v} is None:")
+                        src.append(f"        {v} = asm.parse_register(None, pc, {a})")
+                    elif fp.kind == "i":
+                        src.append(f"    {v} = asm.parse_immediate(None, pc, {a})")
+                    else:
+                        src.append(f"    {v} = asm.labels.get({a})")
+                        src.append(f"    if {v} is None:")
+                        src.append(f"        asm.report_invalid_arg({fp.kind!r}, {a})")
+                        if fp.kind == "l":
+                            src.append(f"    {v} -= pc")
+                    if fp.signed:
+                        src.append(f"    if {v} >= {fp.hi!r} or {v} < {fp.lo!r}:")
+                        src.append(
+                            f"        asm.report_err('Immediate/Label out of range', "
+                            f"'{fp.size}-bit space, but |{{}}| > 2^{fp.size - 1}'"
+                            f".format({v}))"
+                        )
+                        src.append(f"    {v} &= {fp.mask}")
+                    elif fp.unsigned:
+                        src.append(f"    if {v} >= {fp.hi!r}:")
+                        src.append(
+                            f"        asm.report_err('Label out of range', "
+                            f"'{fp.size}-bit space, but {{}} >= 2^{fp.size}'"
+                            f".format({v}))"
+                        )
+                elif fp.const is not None:
+                    val = fp.const
+                    if swap and 0 <= val < len(swap):
+                        val = swap[val]
+                    names.append(val)
+                    continue
+                else:
+                    # always raises, but only once earlier fields have been checked
+                    src.append(f"    {v} = asm.parse_part({fp.kind!r}, None, pc)")
+                if swap:
+                    src.append(f"    if 0 <= {v} < {len(swap)}:")
+                    src.append(f"        {v} = {swap!r}[{v}]")
+                names.append(v)
+
+            terms = []
+            for k, shift in zip(plan.order, plan.shifts):
+                name = names[k]
+                if isinstance(name, int):
+                    const += name << shift
+                elif shift:
+                    terms.append(f"({name} << {shift})")
+                else:
+                    terms.append(name)
+            if const or not terms:
+                terms.insert(0, str(const))
+            src.append("    return " + " + ".join(terms))
+            src.append("")
+
+        return "\n".join(src)
+
+    def prettyprint_assembly(
+        self,
+        instructions: Sequence[Instruction],
+        labels: dict[str, int],
+        colorize: bool = False,
+    ) -> str:
+        """Return a pretty-printed string of the instructions and their
+        assembled machine code (see write_listing()).
+        """
+        out = io.StringIO()
+        self.write_listing(out, instructions, labels, colorize)
+        return out.getvalue()
+
+    @staticmethod
+    def listing_width(instructions: Iterable[Instruction]) -> int:
+        """Width of the instruction column in a listing of instructions."""
+        max_inst_width = max((len(inst.line.text) for inst in instructions), default=None)
+        if max_inst_width is None:
+            return 15
+        return max(max_inst_width, 12)  # always at *least* 12 chars
+
+    def write_listing(
+        self,
+        out: TextIO,
+        instructions: Iterable[Instruction],
+        labels: dict[str, int],
+        colorize: bool = False,
+        width: int | None = None,
+    ) -> None:
+        """Write a listing of the instructions and their assembled machine
+        code to a text file, a line at a time.
+
+        width is the width of the instruction column; if not given, it is
+        found with a first pass over the instructions (which must then be a
+        sequence, not just an iterable).
+        """
+        if width is None:
+            assert isinstance(instructions, Sequence)
+            width = self.listing_width(instructions)
+
+        header = "  #: {0:<{1}}  {2:<20}  {3}\n".format(
+            "Instruction", width, "Binary", "Hex"
+        )
+        out.write(header)
+        out.write("-" * len(header) + "\n")
+
+        # map addresses to labels (the last defined, if an address has several)
+        linelabels = {pc: label for (label, pc) in labels.items()}
+
+        for pc, inst in enumerate(instructions):
+            inst_str = " ".join(part[0] for part in inst.text_parts)
+            # Pad to the column width with spaces.
+            # (Pre-compute because don't want to count added <span> chars when colorized.)
+            padding = " " * (width - len(inst_str))
+
+            if colorize:
+                inst_str = " ".join(
+                    f"<span style='color: {part[1]}'>{part[0]}</span>"
+                    for part in inst.text_parts
+                )
+
+            inst_str += padding
+
+            # Pad to 20 chars with spaces.
+            padding_len = 20 - self.inst_size - (len(inst.bin_parts) - 1)
+            if colorize:
+                instbinstr = " ".join(
+                    f"<span style='color: {part.color}'>{part.bin_str}</span>"
+                    for part in inst.bin_parts
+                ) + (" " * padding_len)
+            else:
+                instbinstr = " ".join(part.bin_str for part in inst.bin_parts) + (
+                    " " * padding_len
+                )
+
+            insthex = "{:04x}".format(inst.binary)
+
+            if pc in linelabels:
+                out.write(linelabels[pc] + ":\n")
+
+            # (Can't use format string justification because of added <span> chars.)
+            out.write("{:3}: {}  {}  {}\n".format(pc, inst_str, instbinstr, insthex))
 
-        # create sizes and arg counts for each instruction
-        # modifies instruction dictionaries within self.instructions
-        for inst_info in self.instructions.values():
-            # figure out number of required arguments to instruction
-            # (count number of parts of types that require arguments)
-            parts = inst_info["parts"]
-            inst_info["args"] = sum(parts.count(c) for c in "rilj")
-
-            # figure out sizes (for shift amounts)
-            sizes = []
-            rem = self.inst_size  # remaining bits
-            for c in inst_info["parts"]:
-                if c in self.field_sizes:
-                    sizes.append(self.field_sizes[c])
-                    rem -= self.field_sizes[c]
-            if rem:
-                # any extra gets all remaining bits
-                inst_info["parts"].append("x")
-                sizes.append(rem)
-
-            inst_info["sizes"] = sizes
+
+class Assembler:
+    """Assembles CS256 assembly code into machine code following definitions
+    given in the specified config file (or an already-loaded ISA).
+
+    The ISA itself is shared and immutable; an Assembler adds the state of
+    assembling one program at a time (labels, messages, and caches), so
+    concurrent assemblies each need their own Assembler (see assemble()).
+    Attributes of the ISA (name, plans, etc.) can be read from the
+    Assembler as well.
+    """
+
+    def __init__(
+        self,
+        configfile: "str | PurePath | ISA",
+        info_callback: InfoCallback | None = None,
+        backend: str = "plan",
+        cache_size: int = 4096,
+        use_cache: bool = True,
+        stats: bool = False,
+    ) -> None:
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend: {backend}")
+        if backend == "numpy":
+            # optional, and slow to import: only loaded for this backend
+            try:
+                import numpy  # noqa: F401
+            except ImportError:
+                backend = "plan"  # NumPy not installed
+        self.backend = backend
+
+        # phase timings and counts, reported by report_stats() (if collected)
+        self.stats: Stats | None = Stats() if stats else None
+
+        if isinstance(configfile, ISA):
+            self.isa = configfile
+        else:
+            with self.phase("config"):
+                self.isa = ISA.from_file(configfile, use_cache)
+
+        self.report_commas = True
 
         # Used internally
-        self.inst_regex = r"({})\s".format("|".join(self.instructions))
+        # Parse functions for each field kind
+        self.part_parsers: dict[str, Callable[[ISAInfo, int, str | None], int]] = {
+            "o": self.parse_opcode,
+            "f": self.parse_funccode,
+            "r": self.parse_register,
+            "i": self.parse_immediate,
+            "j": self.parse_abs_label,
+            "l": self.parse_rel_label,
+            "x": self.parse_unused,
+            "y": self.parse_unused,
+            "z": self.parse_unused,
+        }
         self.labels: dict[str, int] = {}
         self.cur_line: ASMLine | None = None  # used for error reporting
 
         self.info_callback = info_callback
 
+        # LRU cache of encodings for instructions w/o label operands (which do
+        # not depend on pc), keyed by normalized instruction text.  Entries
+        # hold the binary word plus, if assemble_instruction() has produced
+        # them, its text parts and binary fields.
+        self.cache_size = cache_size
+        self.encoding_cache: OrderedDict[
+            str,
+            tuple[int, list[tuple[str, str]] | None, list[BinaryField] | None],
+        ] = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def __getattr__(self, name: str) -> Any:
+        # (only called for attributes not found normally)
+        if name == "isa":
+            raise AttributeError(name)
+        return getattr(self.isa, name)
+
     def register_info_callback(self, info_callback: InfoCallback) -> None:
         self.info_callback = info_callback
 
     def add_swap(self, kind: str, v1: int, v2: int) -> None:
-        self.value_swaps[kind][v1] = v2
-        self.value_swaps[kind][v2] = v1
+        self.isa = self.isa.with_swap(kind, v1, v2)
+        self.encoding_cache.clear()
 
-    def assemble_instruction(self, line: ASMLine, pc: int) -> Instruction:
-        """Produce the binary encoding of one instruction."""
-        assert re.match(self.inst_regex, line.text)
+    def prepare_instruction(self, line: ASMLine) -> tuple[EncodingPlan, list[str]]:
+        """Check an instruction's arguments and return its plan and its
+        parts (mnemonic followed by operands)."""
+        if line.mnemonic is None:
+            # not produced by first_pass(); classify it now
+            self.isa.lex_instruction(line)
+        assert line.mnemonic is not None and line.operands is not None
 
         self.cur_line = line
 
@@ -166,74 +1094,146 @@ class Assembler:
             line.text = line.text.replace(",", " ")
 
         # split instruction into parts
-        args = line.text.split()
-        text_parts = list(zip(args, self.palette))  # zip() stops at end of shortest
+        args = [line.mnemonic, *line.operands]
 
-        inst_info = self.instructions[args[0]]
+        plan = self.isa.plans[args[0]]
 
         # check for the correct number of arguments
-        if inst_info["args"] != len(args) - 1:
+        if plan.args != len(args) - 1:
             self.report_err(
                 "Incorrect number of arguments in instruction (expected {}, got {})".format(
-                    inst_info["args"], len(args) - 1
+                    plan.args, len(args) - 1
                 ),
                 line.text,
             )
 
-        bin_parts = []
-        text_part_iter = iter(text_parts)
-        for kind, size in zip(inst_info["parts"], inst_info["sizes"]):
-            if kind in ["o", "r", "l", "j", "i"]:
-                # these have arguments
-                arg, color = next(text_part_iter)
-                val = self.parse_part(kind, inst_info, pc, arg)
+        return plan, args
+
+    def assemble_instruction(self, line: ASMLine, pc: int) -> Instruction:
+        """Produce the binary encoding of one instruction."""
+        plan, args = self.prepare_instruction(line)
+
+        key = None
+        if self.cache_size and not plan.uses_labels:
+            key = " ".join(args)
+            cached = self.encoding_cache.get(key)
+            if cached is not None and cached[1] is not None:
+                self.cache_hits += 1
+                self.encoding_cache.move_to_end(key)
+                return Instruction(line, cached[1], cached[2], cached[0])  # type: ignore[arg-type]
+            self.cache_misses += 1
+
+        instruction_bin, vals = self.encode_values(plan, args, pc)
+        inst = self.build_instruction(line, plan, args, vals, instruction_bin)
+
+        if key is not None:
+            self.cache_store(key, (instruction_bin, inst.text_parts, inst.bin_parts))
+
+        return inst
+
+    def encode_values(
+        self, plan: EncodingPlan, args: list[str], pc: int
+    ) -> tuple[int, list[int]]:
+        """Produce the binary word and field values of a prepared instruction."""
+        if self.backend == "codegen":
+            instruction_bin = self.isa.get_encoders()[args[0]](self, args[1:], pc)
+            return instruction_bin, self.isa.decode_fields(plan, instruction_bin)
+        vals = self.encode_fields(plan, args, pc)
+        return self.isa.combine_fields(plan, vals), vals
+
+    def build_instruction(
+        self,
+        line: ASMLine,
+        plan: EncodingPlan,
+        args: list[str],
+        vals: list[int],
+        instruction_bin: int,
+    ) -> Instruction:
+        """Build the Instruction for an encoded instruction."""
+        text_parts = list(zip(args, self.isa.palette))  # zip() stops at end of shortest
+
+        fields = []
+        for fp, val in zip(plan.fields, vals):
+            # Convert to binary; rjust() adds leading 0s if needed.
+            bin_str = bin(val)[2:].rjust(fp.size, "0")
+            fields.append(BinaryField(fp.kind, fp.size, bin_str, val, fp.color))
+        bin_parts = [fields[i] for i in plan.order]
+
+        return Instruction(line, text_parts, bin_parts, instruction_bin)
 
-                if kind in ["l", "i"]:
+    def encode_instruction(self, line: ASMLine, pc: int) -> int:
+        """Produce just the binary word for one instruction."""
+        plan, args = self.prepare_instruction(line)
+        if not self.cache_size or plan.uses_labels:
+            return self.encode_args(plan, args, pc)
+
+        key = " ".join(args)
+        cached = self.encoding_cache.get(key)
+        if cached is not None:
+            self.cache_hits += 1
+            self.encoding_cache.move_to_end(key)
+            return cached[0]
+        self.cache_misses += 1
+        instruction_bin = self.encode_args(plan, args, pc)
+        self.cache_store(key, (instruction_bin, None, None))
+        return instruction_bin
+
+    def cache_store(
+        self,
+        key: str,
+        entry: tuple[int, list[tuple[str, str]] | None, list[BinaryField] | None],
+    ) -> None:
+        self.encoding_cache[key] = entry
+        self.encoding_cache.move_to_end(key)
+        if len(self.encoding_cache) > self.cache_size:
+            self.encoding_cache.popitem(last=False)
+
+    def encode_args(self, plan: EncodingPlan, args: list[str], pc: int) -> int:
+        """Produce the binary word for a prepared instruction."""
+        if self.backend == "codegen":
+            return self.isa.get_encoders()[args[0]](self, args[1:], pc)
+        return self.isa.combine_fields(plan, self.encode_fields(plan, args, pc))
+
+    def encode_fields(self, plan: EncodingPlan, args: list[str], pc: int) -> list[int]:
+        """Compute the value of each field of an instruction, in config order."""
+        parsers = self.part_parsers
+        vals = []
+        for fp, swap in zip(plan.fields, plan.swaps):
+            if fp.kind in "rilj":
+                arg = args[fp.argpos]  # type: ignore[index]
+                val = parsers[fp.kind](plan.inst_info, pc, arg)
+                if fp.signed:
                     # check 2's complement immediate or branch (offset) size
-                    if val >= 2 ** (size - 1) or val < -(2 ** (size - 1)):
+                    if val >= fp.hi or val < fp.lo:
                         self.report_err(
                             "Immediate/Label out of range",
-                            "{}-bit space, but |{}| > 2^{}".format(size, val, size - 1),
+                            "{}-bit space, but |{}| > 2^{}".format(
+                                fp.size, val, fp.size - 1
+                            ),
                         )
                     # fit negative values into given # of bits
-                    val = val % 2**size
-                elif kind == "j":
+                    val &= fp.mask
+                elif fp.unsigned and val >= fp.hi:
                     # check absolute address size
-                    if val >= 2 ** (size):
-                        self.report_err(
-                            "Label out of range",
-                            "{}-bit space, but {} >= 2^{}".format(size, val, size),
-                        )
+                    self.report_err(
+                        "Label out of range",
+                        "{}-bit space, but {} >= 2^{}".format(
+                            fp.size, val, fp.size
+                        ),
+                    )
+            elif fp.const is not None:
+                val = fp.const
             else:
-                # other kinds ('x', funccode) do not
-                val = self.parse_part(kind, inst_info, pc)
-                color = "#999999"
+                # unknown kind or missing opcode/funccode: report as before
+                val = self.parse_part(fp.kind, plan.inst_info, pc)
 
             # Apply swaps given on cmdline
-            val = self.value_swaps.get(kind, {}).get(val, val)
-
-            # Convert to binary; rjust() adds leading 0s if needed.
-            bin_str = bin(val)[2:].rjust(size, "0")
-            bin_parts.append(BinaryField(kind, size, bin_str, val, color))
-
-        if inst_info.get("tweak") == "flip_args":
-            # Swap first and second operand
-            # e.g., for a Store instruction w/ dest address written first but it needs to be 2nd reg.
-            # e.g., for a Branch instruction where we want the immediate to be first in the encoding but we write the label second in the assembly instruction
-            bin_parts[1], bin_parts[2] = bin_parts[2], bin_parts[1]
-
-        elif inst_info.get("tweak") == "dupe1to3":
-            # Copy first operand to third (end) position
-            # e.g., for a Store instruction w/ src data as first arg, but ISA typically has src reg as second and third args
-            bin_parts.append(bin_parts[1])
+            if swap and 0 <= val < len(swap):
+                val = swap[val]
 
-        # build final binary by shifting and summing each part
-        instruction_bin = 0
-        for field in bin_parts:
-            instruction_bin <<= field.size
-            instruction_bin += field.val
+            vals.append(val)
 
-        return Instruction(line, text_parts, bin_parts, instruction_bin)
+        return vals
 
     def parse_part(
         self, type: str, inst_info: ISAInfo, pc: int, arg: str | None = None
@@ -241,150 +1241,591 @@ class Assembler:
         """Parse one argument of an instruction (opcode, register,
         immediate, or label).
         """
-        # print(f"Type {type}  arg {arg}")
-
-        if type == "o":
-            return inst_info["opcode"]
-        elif type == "f":
-            return inst_info["funccode"]
-        elif type == "r" and arg in self.special_regs:
-            return self.special_regs[arg]
-        elif (
-            type == "r"
-            and arg
-            and re.match(r"^{}\d+$".format(re.escape(self.reg_prefix)), arg)
-        ):
-            regindex = int(arg[1:])
-            if regindex > self.max_reg:
+        parser = self.part_parsers.get(type)
+        if parser is None:
+            self.report_invalid_arg(type, arg)
+        return parser(inst_info, pc, arg)
+
+    def parse_opcode(self, inst_info: ISAInfo, pc: int, arg: str | None) -> int:
+        return inst_info["opcode"]
+
+    def parse_funccode(self, inst_info: ISAInfo, pc: int, arg: str | None) -> int:
+        return inst_info["funccode"]
+
+    def parse_unused(self, inst_info: ISAInfo, pc: int, arg: str | None) -> int:
+        # unused - fill w/ zero bits
+        return 0
+
+    def parse_register(self, inst_info: ISAInfo, pc: int, arg: str | None) -> int:
+        regindex = self.isa.registers.get(arg)  # type: ignore[arg-type]
+        if regindex is not None:
+            return regindex
+        # not a canonical spelling (e.g., leading zeros or out of range)
+        if arg and self.isa.reg_regex.match(arg):
+            regindex = int(arg[len(self.isa.reg_prefix) :])
+            if regindex > self.isa.max_reg:
                 self.report_err("Register out of range", regindex)
             return regindex
-        elif (
-            type == "i"
-            and arg
-            and re.match(r"^-?\d+$|^-?0x[a-fA-F0-9]+$|^-?0b[01]+$", arg)
-        ):
+        self.report_invalid_arg("r", arg)
+
+    def parse_immediate(self, inst_info: ISAInfo, pc: int, arg: str | None) -> int:
+        if arg and self.isa.imm_regex.match(arg):
             try:
                 return int(arg, 0)
             except ValueError as e:
                 self.report_err(str(e))
-        elif type == "j" and arg in self.labels:
-            return self.labels[arg]
-        elif type == "l" and arg in self.labels:
-            # offset from pc, so store instruction count - pc
-            return self.labels[arg] - pc
-        elif type in "xyz":  # unused - fill w/ zero bits
-            return 0
-        else:
-            self.report_err("Invalid instruction argument", f"{arg} - type {type}")
+        self.report_invalid_arg("i", arg)
+
+    def parse_abs_label(self, inst_info: ISAInfo, pc: int, arg: str | None) -> int:
+        addr = self.labels.get(arg)  # type: ignore[arg-type]
+        if addr is None:
+            self.report_invalid_arg("j", arg)
+        return addr
+
+    def parse_rel_label(self, inst_info: ISAInfo, pc: int, arg: str | None) -> int:
+        addr = self.labels.get(arg)  # type: ignore[arg-type]
+        if addr is None:
+            self.report_invalid_arg("l", arg)
+        # offset from pc, so store instruction count - pc
+        return addr - pc
+
+    def assemble_instructions(
+        self, instructions: list[ASMLine], executor: "Executor | None" = None
+    ) -> list[Instruction]:
+        """Assemble a list of instructions.
+
+        With an executor (e.g., from parallel_executor()), a large program is
+        encoded in parallel chunks (see encode_parallel()).  Instructions are
+        still built here, so this gains less than assemble_words() does.
+        The "numpy" backend encodes the whole program at once instead (see
+        encode_batch()), recovering each instruction's fields from its word.
+        """
+        if self.backend == "numpy":
+            words = self.encode_batch(instructions).tolist()
+            return self.build_instructions(
+                instructions, ((word, None) for word in words)
+            )
+        if executor is None or len(instructions) <= PARALLEL_MIN_CHUNK:
+            return [
+                self.assemble_instruction(line, pc)
+                for pc, line in enumerate(instructions)
+            ]
+        return self.build_instructions(
+            instructions, self.encode_parallel(instructions, executor)
+        )
 
-        return -1
+    def build_instructions(
+        self,
+        instructions: list[ASMLine],
+        results: Iterable[tuple[int, list[int] | None]],
+    ) -> list[Instruction]:
+        """Build the Instructions for already encoded instructions, given a
+        (word, field values) pair for each (values None to decode them from
+        the word), reusing the text and fields of identical instructions."""
+        ret = []
+        for line, (instruction_bin, vals) in zip(instructions, results):
+            args = [line.mnemonic, *line.operands]  # type: ignore[misc]
+            plan = self.isa.plans[args[0]]  # type: ignore[index]
+            key = None
+            if self.cache_size and not plan.uses_labels:
+                # reuse text and fields of identical instructions
+                key = " ".join(args)  # type: ignore[arg-type]
+                cached = self.encoding_cache.get(key)
+                if cached is not None and cached[1] is not None:
+                    ret.append(Instruction(line, cached[1], cached[2], instruction_bin))  # type: ignore[arg-type]
+                    continue
+            if vals is None:
+                vals = self.isa.decode_fields(plan, instruction_bin)
+            inst = self.build_instruction(line, plan, args, vals, instruction_bin)  # type: ignore[arg-type]
+            if key is not None:
+                self.cache_store(key, (instruction_bin, inst.text_parts, inst.bin_parts))
+            ret.append(inst)
+        return ret
 
-    def assemble_instructions(self, instructions: list[ASMLine]) -> list[Instruction]:
-        """Assemble a list of instructions."""
-        return [
-            self.assemble_instruction(line, pc) for pc, line in enumerate(instructions)
-        ]
+    @contextmanager
+    def parallel_run(self, executor: "Executor") -> Iterator["ParallelRun | str"]:
+        """Ship the ISA and labels to an executor's workers once for a run,
+        giving what to pass to each chunk: the run itself for threads, or
+        the name of a temporary file holding it pickled for processes.
+        """
+        import concurrent.futures
 
-    def first_pass(self, lines: Sequence[str]) -> list[ASMLine]:
+        run = ParallelRun(self.isa, self.labels, self.backend, self.cache_size)
+        if isinstance(executor, concurrent.futures.ThreadPoolExecutor):
+            yield run
+            return
+
+        import pickle
+        import tempfile
+
+        # named uniquely, as workers cache the last run by name
+        runfile = os.path.join(
+            tempfile.gettempdir(), "256asm-run-{}.pickle".format(os.urandom(16).hex())
+        )
+        with open(runfile, "xb") as f:
+            pickle.dump(run, f, pickle.HIGHEST_PROTOCOL)
+        try:
+            yield runfile
+        finally:
+            os.remove(runfile)
+
+    def encode_parallel(
+        self, instructions: list[ASMLine], executor: "Executor", words_only: bool = False
+    ) -> list[Any]:
+        """Encode a list of instructions (from first_pass()) in chunks on an
+        executor (see encode_chunk()), giving a word, or a (word, field
+        values) pair, per instruction.
+
+        The ISA and labels are shipped to workers once per run: shared
+        directly with threads, or written to a temporary file that each
+        worker process loads once.  Results, messages, and errors are
+        exactly those of encoding the instructions in order here.
+        """
+        chunk = max(
+            PARALLEL_MIN_CHUNK, -(-len(instructions) // (4 * (os.cpu_count() or 1)))
+        )
+        results: list[Any] = []
+        error = None
+        with self.parallel_run(executor) as run:
+            futures = [
+                executor.submit(
+                    encode_chunk, run, start, instructions[start : start + chunk], words_only
+                )
+                for start in range(0, len(instructions), chunk)
+            ]
+            try:
+                for future in futures:
+                    chunk_results, error = future.result()
+                    results.extend(chunk_results)
+                    if error is not None:
+                        break
+            finally:
+                for future in futures:
+                    future.cancel()
+
+        # Report commas and strip them from each instruction encoded (or
+        # failed), as prepare_instruction() would have done here.
+        done = instructions[: len(results) + (error is not None)]
+        for line in done:
+            if line.mnemonic is None:
+                self.isa.lex_instruction(line)
+            if "," in line.text:
+                if self.report_commas:
+                    self.report_inf("Invalid comma found (stripping all commas)", line.text)
+                    self.report_commas = False
+                line.text = line.text.replace(",", " ")
+        if done:
+            self.cur_line = done[-1]
+
+        if error is not None:
+            raise error
+        return results
+
+    def first_pass(
+        self, lines: Sequence[str], executor: "Executor | None" = None
+    ) -> list[ASMLine]:
         """Take a first pass through the code, cleaning, stripping, and
-        determining label addresses."""
+        determining label addresses.
+
+        With an executor, a large source is split into chunks of lines that
+        are lexed in parallel (see lex_chunk()).  Each chunk's label offsets
+        are made global by adding the number of instructions in all chunks
+        before it, and chunks are merged in order, so labels (the last
+        definition of each wins) and messages are the same as lexing
+        serially.
+        """
         # clear the labels (in case this object is reused)
         self.labels = {}
 
-        instructions = []
+        with self.phase("first_pass"):
+            if executor is None or len(lines) <= PARALLEL_MIN_CHUNK:
+                chunks = [lex_chunk(self.isa.lexer, 0, lines)]
+            else:
+                size = max(
+                    PARALLEL_MIN_CHUNK, -(-len(lines) // (4 * (os.cpu_count() or 1)))
+                )
+                futures = [
+                    executor.submit(
+                        lex_chunk, self.isa.lexer, start, lines[start : start + size]
+                    )
+                    for start in range(0, len(lines), size)
+                ]
+                chunks = [future.result() for future in futures]
+
+        instructions: list[ASMLine] = []
+        with self.phase("labels"):
+            for chunk_instructions, chunk_labels, invalid in chunks:
+                for lineno, line in invalid:
+                    # Uh oh...
+                    self.report_inf(
+                        "Invalid line (ignoring)", "{}: {}".format(lineno, line)
+                    )
+                # chunk-local offsets plus the count of all instructions before the chunk
+                for label, offset in chunk_labels:
+                    self.labels[label] = len(instructions) + offset
+                instructions.extend(chunk_instructions)
+
+        if self.stats is not None:
+            self.stats.count("lines", len(lines))
+            self.stats.count("instructions", len(instructions))
+            self.stats.count("labels", len(self.labels))
+        return instructions
+
+    def assemble_lines(
+        self, lines: Sequence[str], executor: "Executor | None" = None
+    ) -> list[Instruction]:
+        """Fully assemble a list of lines of assembly code.
+        Returns a list of binary-encoded instructions.
+        """
+        instructions = self.first_pass(lines, executor)
+        with self.phase("encode", count_hits=True):
+            return self.assemble_instructions(instructions, executor)
+
+    def assemble_stream(self, lines: Iterable[str], writer: ImageWriter) -> int:
+        """Assemble lines of assembly code in a single pass, writing each
+        instruction's binary to writer as soon as it is seen.
+
+        An instruction using a label that has not been defined yet is written
+        as a placeholder and patched once the label appears, so only
+        unresolved instructions are held in memory.  Messages and errors
+        are the same as for assemble_lines(), but are reported in the order
+        they are found.  Instructions are resolved against the labels seen
+        by the time they are complete, so (unlike assemble_lines()) a label
+        defined more than once may resolve differently for different uses.
+        Returns the number of instructions written.
+        """
+        # clear the labels (in case this object is reused)
+        self.labels = {}
 
-        for lineno, line in enumerate(lines):
-            # one-based counting for lines
-            lineno += 1
+        # label name -> instructions waiting on it: [line, plan, args, pc, # missing]
+        waiting: dict[str, list[list[Any]]] = defaultdict(list)
 
-            # strip comments
-            line = line.partition("#")[0]
-            # clean up
-            line = line.lower().strip()
+        pc = 0
+        for lineno, line in enumerate(lines, 1):
+            line = self.isa.clean_line(line)
 
             if not line:
                 # it's a comment or blank!
                 continue
 
-            if re.match(self.inst_regex, line):
-                # it's an instruction!
-                inst = ASMLine(text=line, lineno=lineno)
-                instructions.append(inst)
-            elif re.match("^[a-z][a-z0-9]*:$", line):
-                # store the label (strip the colon)
-                self.labels[line[:-1]] = len(instructions)
-            else:
+            match = self.isa.lexer.match(line)
+            if match is None:
                 # Uh oh...
                 self.report_inf(
                     "Invalid line (ignoring)", "{}: {}".format(lineno, line)
                 )
+            elif match["mnemonic"]:
+                # it's an instruction!
+                inst = self.isa.make_asmline(line, lineno, match)
+                plan, args = self.prepare_instruction(inst)
+                missing = set()
+                if plan.uses_labels:
+                    for fp in plan.fields:
+                        if fp.kind in ["l", "j"]:
+                            arg = args[fp.argpos]  # type: ignore[index]
+                            if arg not in self.labels and self.isa.label_regex.match(arg):
+                                missing.add(arg)
+                if missing:
+                    fixup: list[Any] = [inst, plan, args, pc, len(missing)]
+                    for label in missing:
+                        waiting[label].append(fixup)
+                    writer.write(0)
+                else:
+                    writer.write(self.encode_args(plan, args, pc))
+                pc += 1
+            else:
+                # store the label and patch anything waiting on it
+                label = match["label"]
+                self.labels[label] = pc
+                for fixup in waiting.pop(label, []):
+                    fixup[4] -= 1
+                    if fixup[4] == 0:
+                        inst, plan, args, inst_pc, _ = fixup
+                        self.cur_line = inst
+                        writer.patch(inst_pc, self.encode_args(plan, args, inst_pc))
+
+        if waiting:
+            # undefined labels: report the first instruction using one
+            inst, plan, args, inst_pc, _ = min(
+                (fixup for fixups in waiting.values() for fixup in fixups),
+                key=lambda fixup: fixup[3],
+            )
+            self.cur_line = inst
+            self.encode_args(plan, args, inst_pc)
 
-        return instructions
+        return pc
 
-    def assemble_lines(self, lines: Sequence[str]) -> list[Instruction]:
-        """Fully assemble a list of lines of assembly code.
-        Returns a list of binary-encoded instructions.
+    def assemble_words(
+        self, lines: Sequence[str], executor: "Executor | None" = None
+    ) -> list[int]:
+        """Fully assemble a list of lines of assembly code into just their
+        binary words, skipping the text, colors, and fields kept for listings.
+        Errors are detected and reported exactly as in assemble_lines().
         """
-        instructions = self.first_pass(lines)
-        return self.assemble_instructions(instructions)
-
-    def prettyprint_assembly(
-        self, instructions: list[Instruction], colorize: bool = False
-    ) -> str:
-        """Return a pretty-printed string of the instructions and their
-        assembled machine code to stdout.
+        if (
+            executor is not None
+            and self.backend != "numpy"
+            and len(lines) > PARALLEL_MIN_CHUNK
+        ):
+            return self.assemble_words_parallel(lines, executor)
+        instructions = self.first_pass(lines, executor)
+        with self.phase("encode", count_hits=True):
+            if self.backend == "numpy":
+                return self.encode_batch(instructions).tolist()
+            return [
+                self.encode_instruction(line, pc) for pc, line in enumerate(instructions)
+            ]
+
+    def assemble_words_parallel(
+        self, lines: Sequence[str], executor: "Executor"
+    ) -> list[int]:
+        """Fully assemble a list of lines of assembly code into binary words,
+        with both passes done by workers in chunks of lines.
+
+        Workers first scan their chunks for instruction counts, labels, and
+        invalid lines (see scan_chunk()), which are merged here as in
+        first_pass().  Then each lexes its chunk again and encodes it
+        against the merged labels (see assemble_chunk()).  Only source
+        text, labels, and words pass between workers and here, not
+        per-instruction objects.  Errors are reported exactly as in
+        assemble_words().
         """
+        # clear the labels (in case this object is reused)
+        self.labels = {}
 
-        # set up linelabels to map line numbers to labels
-        linelabels = {line: label for (label, line) in self.labels.items()}
-
-        if instructions:
-            max_inst_width = max(len(inst.line.text) for inst in instructions)
-            max_inst_width = max(max_inst_width, 12)  # always at *least* 12 chars
-        else:
-            max_inst_width = 15
-
-        header = "  #: {0:<{1}}  {2:<20}  {3}\n".format(
-            "Instruction", max_inst_width, "Binary", "Hex"
-        )
-        header += "-" * len(header) + "\n"
-
-        ret = header
-        for pc, inst in enumerate(instructions):
-            inst_str = " ".join(part[0] for part in inst.text_parts)
-            # Pad to 20 chars with spaces.
-            # (Pre-compute because don't want to count added <span> chars when colorized.)
-            padding = " " * (max_inst_width - len(inst_str))
-
-            if colorize:
-                inst_str = " ".join(
-                    f"<span style='color: {part[1]}'>{part[0]}</span>"
-                    for part in inst.text_parts
+        size = max(PARALLEL_MIN_CHUNK, -(-len(lines) // (4 * (os.cpu_count() or 1))))
+        starts = range(0, len(lines), size)
+        with self.phase("first_pass"):
+            scans = [
+                executor.submit(
+                    scan_chunk, self.isa.lexer, start, lines[start : start + size]
+                )
+                for start in starts
+            ]
+            results = [future.result() for future in scans]
+        pcs = []  # pc of each chunk's first instruction
+        pc = 0
+        with self.phase("labels"):
+            for count, labels, invalid in results:
+                for lineno, line in invalid:
+                    # Uh oh...
+                    self.report_inf(
+                        "Invalid line (ignoring)", "{}: {}".format(lineno, line)
+                    )
+                for label, offset in labels:
+                    self.labels[label] = pc + offset
+                pcs.append(pc)
+                pc += count
+        if self.stats is not None:
+            self.stats.count("lines", len(lines))
+            self.stats.count("instructions", pc)
+            self.stats.count("labels", len(self.labels))
+
+        words: list[int] = []
+        error = None
+        with self.phase("encode"), self.parallel_run(executor) as run:
+            futures = [
+                executor.submit(
+                    assemble_chunk, run, start, chunk_pc, lines[start : start + size]
                 )
+                for start, chunk_pc in zip(starts, pcs)
+            ]
+            try:
+                for future in futures:
+                    chunk_words, error, comma_line = future.result()
+                    if comma_line is not None and self.report_commas:
+                        self.report_inf("Invalid comma found (stripping all commas)", comma_line)
+                        self.report_commas = False
+                    words.extend(chunk_words)
+                    if error is not None:
+                        break
+            finally:
+                for future in futures:
+                    future.cancel()
+
+        if error is not None:
+            raise error
+        return words
+
+    def encode_batch(self, instructions: list[ASMLine]) -> "np.ndarray":
+        """Encode a list of instructions (from first_pass()) into an array of
+        binary words using NumPy.
+
+        Identical instructions encode identically (unless pc-relative), so
+        each distinct instruction is checked and parsed just once.  They are
+        grouped by mnemonic, and each group's range checks, wrapping, swaps,
+        and shifts are done on whole columns of operand values, with the
+        resulting words scattered to every pc where they occur.
+
+        If any instruction is invalid, the first one is re-encoded on its own
+        to report exactly the error assemble_lines() would.
+        """
+        import numpy as np
+
+        word_bits = self.isa.word_bits()
+        dtype = np.uint16 if word_bits <= 16 else np.uint32 if word_bits <= 32 else np.uint64
+        words = np.zeros(len(instructions), dtype=dtype)
+
+        occurrences: dict[str, list[int]] = defaultdict(list)  # text -> pcs
+        for pc, line in enumerate(instructions):
+            occurrences[line.text].append(pc)
+
+        # Check arguments and group by mnemonic, noting the first bad
+        # instruction.  The comma message is held back until it is known
+        # whether an error precedes it.
+        report_commas = self.report_commas
+        self.report_commas = False
+        comma_line = None
+        first_err = len(instructions)
+        plans = self.isa.plans
+        groups: dict[str, tuple[list[list[int]], list[list[str]]]] = defaultdict(
+            lambda: ([], [])
+        )
+        for text, pcs in occurrences.items():
+            line = instructions[pcs[0]]
+            if line.operands is None or "," in text:
+                if report_commas and "," in text:
+                    if comma_line is None or pcs[0] < comma_line[0]:
+                        comma_line = (pcs[0], text)
+                try:
+                    self.prepare_instruction(line)  # (lexes it, strips commas)
+                except AssemblerException:
+                    first_err = min(first_err, pcs[0])
+                    continue
+            assert line.mnemonic is not None and line.operands is not None
+            if plans[line.mnemonic].args != len(line.operands):
+                first_err = min(first_err, pcs[0])
+                continue
+            group = groups[line.mnemonic]
+            group[0].append(pcs)
+            group[1].append(line.operands)
+
+        for inst, (pc_lists, rows) in groups.items():
+            plan = plans[inst]
+            if any(fp.kind == "l" for fp in plan.fields):
+                # pc-relative: encode each occurrence separately
+                rows = [operands for operands, pcs in zip(rows, pc_lists) for _ in pcs]
+                pc_lists = [[pc] for pcs in pc_lists for pc in pcs]
+            # (for reporting parse errors, which are caught below)
+            self.cur_line = instructions[pc_lists[0][0]]
+            pc_col = np.array([pcs[0] for pcs in pc_lists], dtype=np.int64)
+            err = np.zeros(len(rows), dtype=bool)
+            word = np.zeros(len(rows), dtype=np.int64)
+            vals: list[Any] = []
+            for fp, swap in zip(plan.fields, plan.swaps):
+                if fp.kind in "rilj":
+                    assert fp.argpos is not None
+                    column = [operands[fp.argpos - 1] for operands in rows]
+                    val, bad = self.resolve_column(fp.kind, plan, column)
+                    err[bad] = True
+                    if fp.kind == "l":
+                        # offset from pc
+                        val -= pc_col
+                    if fp.signed:
+                        # check 2's complement immediate or branch (offset) size,
+                        # then fit negative values into given # of bits
+                        err |= (val >= fp.hi) | (val < fp.lo)
+                        val &= fp.mask
+                    elif fp.unsigned:
+                        # check absolute address size
+                        err |= val >= fp.hi
+                elif fp.const is not None:
+                    val = np.full(len(rows), fp.const, dtype=np.int64)
+                else:
+                    # unknown kind or missing opcode/funccode: always an error
+                    err[:] = True
+                    val = np.zeros(len(rows), dtype=np.int64)
+
+                # Apply swaps given on cmdline
+                if swap:
+                    table = np.array(swap, dtype=np.int64)
+                    inrange = (val >= 0) & (val < len(table))
+                    val = np.where(inrange, table[np.clip(val, 0, len(table) - 1)], val)
+                vals.append(val)
+
+            # build final binary by shifting and summing each part
+            for i, shift in zip(plan.order, plan.shifts):
+                word += vals[i] << shift
+            counts = [len(pcs) for pcs in pc_lists]
+            all_pcs = np.fromiter(
+                (pc for pcs in pc_lists for pc in pcs), np.int64, sum(counts)
+            )
+            words[all_pcs] = np.repeat(word.astype(dtype), counts)
+            if err.any():
+                # (each row's first pc is its earliest)
+                first_err = min(first_err, int(pc_col[err].min()))
 
-            inst_str += padding
+        if comma_line and comma_line[0] <= first_err:
+            self.report_inf("Invalid comma found (stripping all commas)", comma_line[1])
+        else:
+            self.report_commas = report_commas
 
-            # Pad to 20 chars with spaces.
-            padding_len = 20 - self.inst_size - (len(inst.bin_parts) - 1)
-            if colorize:
-                instbinstr = " ".join(
-                    f"<span style='color: {field.color}'>{field.bin_str}</span>"
-                    for field in inst.bin_parts
-                ) + (" " * padding_len)
-            else:
-                instbinstr = " ".join(field.bin_str for field in inst.bin_parts) + (
-                    " " * padding_len
-                )
+        if first_err < len(instructions):
+            # re-encode the first bad instruction by itself to report its error
+            self.encode_instruction(instructions[first_err], first_err)
 
-            insthex = "{:04x}".format(inst.binary)
+        return words
 
-            if pc in linelabels:
-                ret += linelabels[pc] + ":\n"
+    def resolve_column(
+        self, kind: str, plan: EncodingPlan, column: Sequence[str]
+    ) -> tuple["np.ndarray", list[int]]:
+        """Parse one operand of every instruction in a group, returning an
+        array of values (label addresses for 'l') and the indices of any
+        invalid operands (whose values are left as 0).
+        """
+        import numpy as np
+
+        parse = self.part_parsers[kind]
+        known = self.isa.registers if kind == "r" else self.labels if kind in "lj" else {}
+        values: dict[str, int | None] = {}
+        for arg in dict.fromkeys(column):  # each distinct operand, once
+            val = known.get(arg)
+            if val is None:
+                try:
+                    # (pc=0, so an 'l' label gives its address, not an offset)
+                    val = parse(plan.inst_info, 0, arg)
+                except AssemblerException:
+                    val = None
+                if val is not None and not -(2**62) <= val < 2**62:
+                    val = None  # certainly out of range (and too big for int64)
+            values[arg] = val
+        bad: list[int] = []
+        if None in values.values():
+            bad = [i for i, arg in enumerate(column) if values[arg] is None]
+            values = {arg: val or 0 for arg, val in values.items()}
+        vals = np.fromiter(map(values.__getitem__, column), np.int64, len(column))
+        return vals, bad
+
+    def assemble_table(self, lines: Sequence[str]) -> InstructionTable:
+        """Fully assemble a list of lines of assembly code into a compact
+        InstructionTable (see that class) instead of a list of Instructions.
+        """
+        instructions = self.first_pass(lines)
+        table = InstructionTable(self, lines, self.isa.word_bits())
+        for pc, line in enumerate(instructions):
+            plan, args = self.prepare_instruction(line)
+            word, vals = self.encode_values(plan, args, pc)
+            table.append(line.lineno, args[0], vals, word)
+        return table
 
-            # (Can't use format string justification because of added <span> chars.)
-            ret += "{:3}: {}  {}  {}\n".format(pc, inst_str, instbinstr, insthex)
+    def prettyprint_assembly(
+        self, instructions: Sequence[Instruction], colorize: bool = False
+    ) -> str:
+        """Return a pretty-printed string of the instructions and their
+        assembled machine code to stdout.
+        """
+        return self.isa.prettyprint_assembly(instructions, self.labels, colorize)
 
-        return ret
+    def write_listing(
+        self,
+        out: TextIO,
+        instructions: Iterable[Instruction],
+        colorize: bool = False,
+        width: int | None = None,
+    ) -> None:
+        """Write a listing of the instructions to a text file, a line at a
+        time (see ISA.write_listing())."""
+        self.isa.write_listing(out, instructions, self.labels, colorize, width)
 
     def output_bin(self, filename: str, bytes_data: bytes) -> None:
         """Create a binary image file for the given bytes."""
@@ -406,34 +1847,601 @@ class Assembler:
             f.write(" ".join("{:04x}".format(word) for word in words))
             f.write("\n")
 
-    def assemble_file(self, filename: str, format: str, outfiles: list[str]) -> None:
-        """Fully assemble a memory image file containing CS256 ISA assembly code."""
+    def assemble_file(
+        self,
+        filename: str,
+        format: str,
+        outfiles: list[str],
+        stream: bool = False,
+        listing: bool = True,
+        cache: "BuildCache | None" = None,
+        listing_file: TextIO | None = None,
+    ) -> int:
+        """Fully assemble a memory image file containing CS256 ISA assembly code.
+
+        The listing is written to listing_file (stdout, followed by a blank
+        line, if not given).
+        With stream=True, the file is assembled in a single pass straight to
+        the output files (see assemble_stream()), and no listing is written.
+        With listing=False, only the binary words are produced (see
+        assemble_words()), and no listing is written.
+        With a cache (not used with stream=True), an identical earlier build
+        is reused (see assemble_file_cached()).
+        Returns the number of instructions assembled.
+        """
         self.report_inf("Assembling", filename)
+        if cache is not None and not stream:
+            return self.assemble_file_cached(
+                filename, format, outfiles, listing, cache, listing_file
+            )
+        if stream:
+            with open(filename) as f, self.phase("stream"):
+                writer = ImageWriter(format, outfiles, self.isa.word_bits())
+                try:
+                    count = self.assemble_stream(f, writer)
+                except BaseException:
+                    writer.discard()
+                    raise
+                writer.finish()
+            if self.stats is not None:
+                self.stats.count("instructions", count)
+                self.stats.count("labels", len(self.labels))
+                self.stats.count(
+                    "bytes",
+                    sum(os.path.getsize(name) for name in image_files(format, outfiles)),
+                )
+            self.report_inf("Generated", ", ".join(outfiles))
+            self.report_stats()
+            return count
+
         with open(filename) as f:
             lines = f.readlines()
 
-        instructions = self.assemble_lines(lines)
+        if listing:
+            instructions = self.assemble_lines(lines)
+            with self.phase("listing"):
+                self.write_listing(listing_file or sys.stdout, instructions)
+                if listing_file is None:
+                    print()
+            binary = [inst.binary for inst in instructions]
+        else:
+            binary = self.assemble_words(lines)
 
-        print(self.prettyprint_assembly(instructions))
+        self.write_image(format, outfiles, binary)
 
-        binary = [inst.binary for inst in instructions]
-        bytes_low = bytes(word % 256 for word in binary)
-        bytes_high = bytes(word // 256 for word in binary)
+        self.report_inf("Generated", ", ".join(outfiles))
+        self.report_stats()
+        return len(binary)
 
-        if format == "bin":
-            self.output_bin(outfiles[0], bytes_low)
-            self.output_bin(outfiles[1], bytes_high)
-        elif format == "256sim":
-            self.output_sim_bin(outfiles[0], binary)
-        elif format == "logisim":
-            self.output_logisim_img(outfiles[0], binary)
+    def assemble_file_cached(
+        self,
+        filename: str,
+        format: str,
+        outfiles: list[str],
+        listing: bool,
+        cache: "BuildCache",
+        listing_file: TextIO | None = None,
+    ) -> int:
+        """assemble_file(), reusing the build cached for the same source,
+        config, swaps, and format if there is one: its messages and listing
+        are reported again, and output files that already hold its outputs
+        are left untouched.  Failed builds are not cached.
+        """
+        from buildcache import Build, read_outputs, restore_outputs
+
+        with open(filename, "rb") as f:
+            source = f.read()
+        key = cache.key(source, self.isa, format, listing)
+        build = cache.get(key)
+
+        if build is not None:
+            for msg, data in build.messages:
+                self.report_inf(msg, data)
+            if build.listing is not None:
+                with self.phase("listing"):
+                    self.write_cached_listing(build.listing, listing_file)
+            with self.phase("output"):
+                restore_outputs(outfiles, build.outputs)
+            if self.stats is not None:
+                self.stats.count("cached_builds", 1)
+        else:
+            messages: list[tuple[str, str]] = []
+            callback = self.info_callback
+
+            def record(msg: tuple[str, Any]) -> None:
+                messages.append((msg[0], str(msg[1])))
+                if callback:
+                    callback(msg)
+
+            # read as assemble_file() would, from the bytes just hashed
+            lines = io.TextIOWrapper(io.BytesIO(source)).readlines()
+            self.info_callback = record
+            try:
+                if listing:
+                    instructions = self.assemble_lines(lines)
+                    with self.phase("listing"):
+                        text = self.prettyprint_assembly(instructions)
+                        self.write_cached_listing(text, listing_file)
+                    binary = [inst.binary for inst in instructions]
+                else:
+                    binary = self.assemble_words(lines)
+                    text = None
+            finally:
+                self.info_callback = callback
+            self.write_image(format, outfiles, binary)
+            written = image_files(format, outfiles)
+            build = Build(len(binary), messages, text, read_outputs(written))
+            cache.put(key, build)
 
         self.report_inf("Generated", ", ".join(outfiles))
+        self.report_stats()
+        return build.count
+
+    @staticmethod
+    def write_cached_listing(text: str, listing_file: TextIO | None) -> None:
+        if listing_file is None:
+            print(text)
+        else:
+            listing_file.write(text)
+
+    def write_image(self, format: str, outfiles: list[str], binary: list[int]) -> None:
+        """Write binary words to memory image file(s) in the given format."""
+        with self.phase("output"):
+            bytes_low = bytes(word % 256 for word in binary)
+            bytes_high = bytes(word // 256 for word in binary)
+
+            if format == "bin":
+                self.output_bin(outfiles[0], bytes_low)
+                self.output_bin(outfiles[1], bytes_high)
+            elif format == "256sim":
+                self.output_sim_bin(outfiles[0], binary)
+            elif format == "logisim":
+                self.output_logisim_img(outfiles[0], binary)
+
+        if self.stats is not None:
+            self.stats.count(
+                "bytes", sum(os.path.getsize(name) for name in image_files(format, outfiles))
+            )
+
+    def phase(self, name: str, count_hits: bool = False) -> AbstractContextManager[None]:
+        """Time a phase of assembling (and count the encoding cache hits and
+        misses during it, if count_hits) into the stats, if collecting them."""
+        if self.stats is None:
+            return NO_STATS
+        return self.stats.phase(
+            name, (lambda: (self.cache_hits, self.cache_misses)) if count_hits else None
+        )
+
+    def report_stats(self) -> None:
+        """Report the stats collected so far via the info callback, as a
+        Stats object followed by the encoding cache's hit rate (if
+        collecting them)."""
+        if self.stats is not None:
+            self.report_inf("Stats", self.stats)
+            self.report_cache_stats()
+
+    def report_cache_stats(self) -> None:
+        """Report the encoding cache's hit rate via the info callback."""
+        lookups = self.cache_hits + self.cache_misses
+        rate = self.cache_hits / lookups if lookups else 0.0
+        self.report_inf(
+            "Encoding cache",
+            "{} hits / {} lookups ({:.1%}), {} entries".format(
+                self.cache_hits, lookups, rate, len(self.encoding_cache)
+            ),
+        )
 
-    def report_err(self, msg: str, data: Any = "") -> None:
+    def report_err(self, msg: str, data: Any = "") -> NoReturn:
         assert self.cur_line
         raise AssemblerException(msg, data, self.cur_line.lineno, self.cur_line.text)
 
+    def report_invalid_arg(self, type: str, arg: str | None) -> NoReturn:
+        self.report_err("Invalid instruction argument", f"{arg} - type {type}")
+
     def report_inf(self, msg: str, data: Any = "") -> None:
         assert self.info_callback
         self.info_callback((msg, data))
+
+
+# Programs are encoded in parallel in chunks of at least this many instructions.
+PARALLEL_MIN_CHUNK = 2048
+
+
+@dataclass
+class ParallelRun:
+    """Everything workers need to encode chunks of one program."""
+
+    isa: ISA
+    labels: dict[str, int]
+    backend: str
+    cache_size: int
+
+    def assembler(self) -> Assembler:
+        asm = Assembler(self.isa, None, self.backend, self.cache_size)
+        asm.labels = self.labels
+        asm.report_commas = False  # reported by the assembler running the program
+        return asm
+
+
+def lex_chunk(
+    lexer: re.Pattern[str], start: int, lines: Sequence[str]
+) -> tuple[list[ASMLine], list[tuple[str, int]], list[tuple[int, str]]]:
+    """Classify a chunk of source lines that starts after line number start.
+
+    Returns the chunk's instructions, its labels in order with their
+    addresses relative to the start of the chunk, and its invalid lines
+    (line number and cleaned text).
+    """
+    instructions = []
+    labels = []
+    invalid = []
+
+    # one-based counting for lines
+    for lineno, line in enumerate(lines, start + 1):
+        line = ISA.clean_line(line)
+
+        if not line:
+            # it's a comment or blank!
+            continue
+
+        match = lexer.match(line)
+        if match is None:
+            invalid.append((lineno, line))
+        elif match["mnemonic"]:
+            # it's an instruction!
+            instructions.append(ISA.make_asmline(line, lineno, match))
+        else:
+            # store the label
+            labels.append((match["label"], len(instructions)))
+
+    return instructions, labels, invalid
+
+
+# in a worker process: the file of the last run seen and its Assembler
+worker_run: tuple[str, Assembler] | None = None
+
+
+def run_assembler(run: ParallelRun | str) -> Assembler:
+    """An Assembler for a worker to encode with: a new one sharing the run
+    (for threads), or one loaded once per run from its file (for processes).
+    """
+    global worker_run
+    if isinstance(run, ParallelRun):
+        return run.assembler()
+    if worker_run is None or worker_run[0] != run:
+        import pickle
+
+        with open(run, "rb") as f:
+            worker_run = (run, pickle.load(f).assembler())
+    return worker_run[1]
+
+
+def encode_chunk(
+    run: ParallelRun | str, start: int, lines: list[ASMLine], words_only: bool
+) -> tuple[list[Any], AssemblerException | None]:
+    """Encode instructions of a run starting at pc start, stopping at the
+    first error.  run is as given by Assembler.parallel_run().
+
+    Returns a word (if words_only) or a (word, field values) pair per
+    instruction encoded, and the error, if any.
+    """
+    if isinstance(run, ParallelRun):
+        # copies, as prepare_instruction() strips commas from the text
+        lines = [ASMLine(l.text, l.lineno, l.mnemonic, l.operands) for l in lines]
+    return encode_lines(run_assembler(run), start, lines, words_only)
+
+
+def encode_lines(
+    asm: Assembler, start: int, lines: list[ASMLine], words_only: bool
+) -> tuple[list[Any], AssemblerException | None]:
+    results: list[Any] = []
+    # (word, field values) of label-free instructions already encoded
+    values: dict[str, tuple[int, list[int]]] = {}
+    try:
+        for pc, line in enumerate(lines, start):
+            if words_only:
+                results.append(asm.encode_instruction(line, pc))
+                continue
+            plan, args = asm.prepare_instruction(line)
+            if plan.uses_labels:
+                results.append(asm.encode_values(plan, args, pc))
+                continue
+            key = " ".join(args)
+            result = values.get(key)
+            if result is None:
+                result = values[key] = asm.encode_values(plan, args, pc)
+            results.append(result)
+    except AssemblerException as e:
+        return results, e
+    return results, None
+
+
+def scan_chunk(
+    lexer: re.Pattern[str], start: int, lines: Sequence[str]
+) -> tuple[int, list[tuple[str, int]], list[tuple[int, str]]]:
+    """Like lex_chunk(), but gives just the number of instructions."""
+    instructions, labels, invalid = lex_chunk(lexer, start, lines)
+    return len(instructions), labels, invalid
+
+
+def assemble_chunk(
+    run: ParallelRun | str, start: int, pc: int, lines: Sequence[str]
+) -> tuple[list[int], AssemblerException | None, str | None]:
+    """Lex a chunk of source lines starting after line number start, and
+    encode its instructions, the first at address pc, into words, stopping
+    at the first error.  run is as given by Assembler.parallel_run().
+
+    Returns the words, the error, if any, and the text of the first
+    instruction encoded (or failed) that contains a comma, if any.
+    """
+    asm = run_assembler(run)
+    instructions = lex_chunk(asm.isa.lexer, start, lines)[0]
+    commas = [i for i, line in enumerate(instructions) if "," in line.text][:1]
+    comma_line = instructions[commas[0]].text if commas else None
+    words, error = encode_lines(asm, pc, instructions, True)
+    if commas and commas[0] >= len(words) + (error is not None):
+        comma_line = None  # not reached
+    return words, error, comma_line
+
+
+def parallel_executor(max_workers: int | None = None) -> "Executor":
+    """An executor for parallel assembly: threads on free-threaded builds of
+    Python (where they run in parallel), otherwise processes."""
+    import concurrent.futures
+
+    if not getattr(sys, "_is_gil_enabled", lambda: True)():
+        return concurrent.futures.ThreadPoolExecutor(max_workers)
+    return concurrent.futures.ProcessPoolExecutor(max_workers)
+
+
+@dataclass
+class AssemblyResult:
+    """The outcome of assemble(): either the assembled program or the error
+    that stopped it, plus any info messages reported along the way."""
+
+    isa: ISA
+    words: list[int]  # binary words (empty on error)
+    instructions: list[Instruction] | None  # None if assembled w/o a listing
+    labels: dict[str, int]
+    messages: list[tuple[str, str]]
+    error: AssemblerException | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def listing(self, colorize: bool = False) -> str:
+        """Pretty-printed listing of the program (see prettyprint_assembly())."""
+        assert self.instructions is not None
+        return self.isa.prettyprint_assembly(self.instructions, self.labels, colorize)
+
+
+def assemble(
+    isa: ISA,
+    lines: Sequence[str],
+    listing: bool = True,
+    backend: str = "plan",
+    cache_size: int = 4096,
+) -> AssemblyResult:
+    """Assemble a list of lines of assembly code for an ISA.
+
+    Has no side effects on its arguments and keeps no state between calls,
+    so it is safe to call from many threads at once with a shared ISA.
+    With listing=False, only the binary words are produced (see
+    Assembler.assemble_words()).  Each call runs its own Assembler, which
+    holds the run's state (labels, messages, encoding cache) and does the
+    work.
+    """
+    messages: list[tuple[str, str]] = []
+    asm = Assembler(isa, messages.append, backend, cache_size)
+    try:
+        if listing:
+            instructions: list[Instruction] | None = asm.assemble_lines(lines)
+            words = [inst.binary for inst in instructions]  # type: ignore[union-attr]
+        else:
+            instructions = None
+            words = asm.assemble_words(lines)
+    except AssemblerException as e:
+        return AssemblyResult(isa, [], None, asm.labels, messages, e)
+    return AssemblyResult(isa, words, instructions, asm.labels, messages)
+
+
+@dataclass
+class SourceLine:
+    """One line of source as classified by IncrementalAssembler."""
+
+    kind: str  # "blank", "label", "invalid", or "inst"
+    text: str  # cleaned text (label name for labels)
+    line: ASMLine | None = None  # for instructions
+    result: Instruction | None = None  # cached encoding
+    key: tuple[int | None, ...] = ()  # label values the cached encoding used
+
+
+class IncrementalAssembler:
+    """Re-assembles successive versions of a source (e.g., as it is edited),
+    redoing only the work an edit affects.
+
+    Only changed lines are re-lexed.  Instructions are re-encoded only if
+    their text changed or a label value they use (an absolute address, or
+    an offset from the instruction's pc) changed; all others reuse their
+    previous encoding.  Results, messages, and errors match those of
+    Assembler.assemble_lines().
+
+    Returned Instructions are shared with the cache and should not be
+    modified.
+    """
+
+    def __init__(self, assembler: Assembler, fresh_runs: bool = False) -> None:
+        self.assembler = assembler
+        # report messages given once per run (invalid commas) on every call
+        self.fresh_runs = fresh_runs
+        self.reset()
+
+    def reset(self) -> None:
+        """Forget all previous work."""
+        self.lines: list[str] = []
+        self.sources: list[SourceLine] = []
+
+    def add_swap(self, kind: str, v1: int, v2: int) -> None:
+        # swaps change encodings, so nothing cached can be reused
+        self.assembler.add_swap(kind, v1, v2)
+        self.reset()
+
+    def lex_line(self, line: str, lineno: int) -> SourceLine:
+        isa = self.assembler.isa
+        text = isa.clean_line(line)
+        if not text:
+            return SourceLine("blank", text)
+        match = isa.lexer.match(text)
+        if match is None:
+            return SourceLine("invalid", text)
+        if match["mnemonic"]:
+            return SourceLine("inst", text, isa.make_asmline(text, lineno, match))
+        return SourceLine("label", match["label"])
+
+    def label_key(
+        self, source: SourceLine, pc: int, labels: dict[str, int]
+    ) -> tuple[int | None, ...]:
+        """The values of any label operands of an instruction."""
+        isa = self.assembler.isa
+        assert source.line and source.line.operands is not None
+        plan = isa.plans[source.line.mnemonic]  # type: ignore[index]
+        key = []
+        for fp in plan.fields:
+            if fp.kind in "lj" and fp.argpos is not None:
+                if fp.argpos > len(source.line.operands):
+                    continue
+                addr = labels.get(source.line.operands[fp.argpos - 1])
+                if addr is not None and fp.kind == "l":
+                    addr -= pc
+                key.append(addr)
+        return tuple(key)
+
+    def assemble_lines(self, lines: Sequence[str]) -> list[Instruction]:
+        """Fully assemble a list of lines of assembly code, reusing work
+        from the previous call where possible.
+        Returns a list of binary-encoded instructions.
+        """
+        asm = self.assembler
+        old_lines = self.lines
+        lines = list(lines)
+
+        # find the edited region (everything outside a common prefix and
+        # suffix) and lex it
+        with asm.phase("first_pass"):
+            limit = min(len(old_lines), len(lines))
+            start = 0
+            while start < limit and old_lines[start] == lines[start]:
+                start += 1
+            end = 0
+            while end < limit - start and old_lines[-1 - end] == lines[-1 - end]:
+                end += 1
+
+            changed = [
+                self.lex_line(line, lineno)
+                for lineno, line in enumerate(lines[start : len(lines) - end], start + 1)
+            ]
+            self.sources[start : len(old_lines) - end] = changed
+            self.lines = lines
+
+        # first pass: labels and instruction addresses, reporting invalid lines
+        with asm.phase("labels"):
+            labels: dict[str, int] = {}
+            insts: list[SourceLine] = []
+            for lineno, source in enumerate(self.sources, 1):
+                if source.kind == "inst":
+                    assert source.line
+                    source.line.lineno = lineno
+                    insts.append(source)
+                elif source.kind == "label":
+                    labels[source.text] = len(insts)
+                elif source.kind == "invalid":
+                    asm.report_inf(
+                        "Invalid line (ignoring)", "{}: {}".format(lineno, source.text)
+                    )
+            asm.labels = labels
+
+        # second pass: encode new instructions and any whose labels moved
+        if self.fresh_runs:
+            asm.report_commas = True
+        instructions = []
+        reused = 0
+        with asm.phase("encode", count_hits=True):
+            for pc, source in enumerate(insts):
+                assert source.line
+                if asm.report_commas and "," in source.text:
+                    # (checked here, as an encoded line's text has commas stripped)
+                    asm.report_inf("Invalid comma found (stripping all commas)", source.text)
+                    asm.report_commas = False
+                if source.result is not None:
+                    key = self.label_key(source, pc, labels) if source.key else ()
+                    if key == source.key:
+                        instructions.append(source.result)
+                        reused += 1
+                        continue
+                source.result = None  # in case encoding fails
+                source.result = asm.assemble_instruction(source.line, pc)
+                source.key = self.label_key(source, pc, labels)
+                instructions.append(source.result)
+
+        if asm.stats is not None:
+            asm.stats.count("lines", len(lines))
+            asm.stats.count("instructions", len(instructions))
+            asm.stats.count("labels", len(labels))
+            asm.stats.count("reused", reused)
+        return instructions
+
+
+class AssemblerPool:
+    """A bounded pool of IncrementalAssemblers sharing one ISA, so that
+    concurrent threads (e.g., serving web requests) each assemble with
+    their own.
+
+    Assemblers are created as needed, up to size of them; get() waits for
+    one to be free if all are in use.  The most recently returned is handed
+    out first, to make the most of its previous work.  With fresh_runs,
+    each run's messages are those of assembling its source from scratch,
+    whichever assembler does it (see IncrementalAssembler).
+    """
+
+    def __init__(
+        self, isa: ISA, size: int, fresh_runs: bool = False, **kwargs: Any
+    ) -> None:
+        import queue  # only needed when serving concurrently
+        import threading
+
+        self.isa = isa
+        self.size = size
+        self.fresh_runs = fresh_runs
+        self.kwargs = kwargs  # for each Assembler
+        self.free: "queue.LifoQueue[IncrementalAssembler]" = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def get(self) -> Iterator[IncrementalAssembler]:
+        """Check out an assembler for the duration of a with block."""
+        import queue
+
+        try:
+            incremental = self.free.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            if create:
+                try:
+                    incremental = IncrementalAssembler(
+                        Assembler(self.isa, **self.kwargs), self.fresh_runs
+                    )
+                except BaseException:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+            else:
+                incremental = self.free.get()
+        try:
+            yield incremental
+        finally:
+            self.free.put(incremental)
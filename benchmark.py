@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+CS256 ISA Assembler: Benchmarks
+Author: Mark Liffiton
+"""
+
+import argparse
+import glob
+import os
+import timeit
+
+from assembler import Assembler, parallel_executor
+
+
+def sample_lines(configfile: str) -> list[str]:
+    """Return the lines of a config's sample file."""
+    a = Assembler(configfile, info_callback=lambda msg: None)
+    with open(a.samplefile) as f:
+        return f.readlines()
+
+
+def best_time(func, repeat: int) -> float:
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def bench_backends(configfiles: list[str], scale: int, repeat: int) -> None:
+    """Compare the "plan" and "codegen" backends on each ISA.
+
+    Samples are assembled scale times rather than concatenated, since a
+    concatenated program would overflow most ISAs' address fields.  The
+    encoding cache is disabled, as it would otherwise answer every
+    repetition and leave the encoders themselves unmeasured.
+    """
+    print(f"Backends (sample x{scale}, best of {repeat})")
+    print(
+        "{:<16} {:>6}  {:>10} {:>10} {:>7}  {:>10} {:>10} {:>7}".format(
+            "ISA", "insts", "lines/plan", "codegen", "speedup", "words/plan", "codegen", "speedup"
+        )
+    )
+    for configfile in configfiles:
+        lines = sample_lines(configfile)
+        times = {}
+        for backend in ("plan", "codegen"):
+            a = Assembler(
+                configfile, info_callback=lambda msg: None, backend=backend, cache_size=0
+            )
+            insts = a.first_pass(lines)
+            a.assemble_instructions(insts)  # warm up (and compile encoders)
+            work = list(enumerate(insts)) * scale
+
+            def run_lines() -> None:
+                for _ in range(scale):
+                    a.assemble_lines(lines)
+
+            def run_words() -> None:
+                for pc, line in work:
+                    a.encode_instruction(line, pc)
+
+            times[backend, "lines"] = best_time(run_lines, repeat)
+            times[backend, "words"] = best_time(run_words, repeat)
+        print(
+            "{:<16} {:>6}  {:>9.1f}m {:>9.1f}m {:>6.2f}x  {:>9.1f}m {:>9.1f}m {:>6.2f}x".format(
+                os.path.basename(configfile)[:-5],
+                len(insts) * scale,
+                times["plan", "lines"] * 1000,
+                times["codegen", "lines"] * 1000,
+                times["plan", "lines"] / times["codegen", "lines"],
+                times["plan", "words"] * 1000,
+                times["codegen", "words"] * 1000,
+                times["plan", "words"] / times["codegen", "words"],
+            )
+        )
+    print()
+
+
+def bench_words(configfiles: list[str], scale: int, repeat: int) -> None:
+    """Compare assemble_words() (binary only) with assemble_lines() on each
+    ISA, and assemble_lines() with and without the encoding cache.
+
+    As above, samples are assembled scale times rather than concatenated.
+    The hit rate is that of the cache in a single run of the sample by a
+    new Assembler, i.e., for a real program rather than repeats of one.
+    """
+    print(f"Binary-only path and encoding cache (sample x{scale}, best of {repeat})")
+    print(
+        "{:<16} {:>8}  {:>10} {:>10} {:>7}  {:>10} {:>7} {:>8}".format(
+            "ISA", "insts", "lines", "words", "speedup", "uncached", "cache", "hit rate"
+        )
+    )
+    for configfile in configfiles:
+        lines = sample_lines(configfile)
+        a = Assembler(configfile, info_callback=lambda msg: None)
+        count = len(a.assemble_lines(lines))
+        hit_rate = a.cache_hits / ((a.cache_hits + a.cache_misses) or 1)
+        uncached = Assembler(configfile, info_callback=lambda msg: None, cache_size=0)
+        times = {}
+        for name, method in (
+            ("lines", a.assemble_lines),
+            ("words", a.assemble_words),
+            ("uncached", uncached.assemble_lines),
+        ):
+
+            def run() -> None:
+                for _ in range(scale):
+                    method(lines)
+
+            times[name] = best_time(run, repeat)
+        print(
+            "{:<16} {:>8}  {:>9.1f}m {:>9.1f}m {:>6.2f}x  "
+            "{:>9.1f}m {:>6.2f}x {:>7.1%}".format(
+                os.path.basename(configfile)[:-5],
+                count * scale,
+                times["lines"] * 1000,
+                times["words"] * 1000,
+                times["lines"] / times["words"],
+                times["uncached"] * 1000,
+                times["uncached"] / times["lines"],
+                hit_rate,
+            )
+        )
+    print()
+
+
+def bench_parallel(configfiles: list[str], scale: int, repeat: int) -> None:
+    """Compare serial and parallel encoding (see Assembler.encode_parallel())
+    of one large program per ISA, with and without building Instructions.
+
+    The program is each sample's label-free instructions repeated scale
+    times, since repeated label uses would overflow their fields.
+    """
+    print(f"Parallel second pass ({os.cpu_count()} CPUs, best of {repeat})")
+    print(
+        "{:<16} {:>8}  {:>10} {:>10} {:>7}  {:>10} {:>10} {:>7}".format(
+            "ISA", "insts", "lines", "parallel", "speedup", "words", "parallel", "speedup"
+        )
+    )
+    with parallel_executor() as executor:
+        for configfile in configfiles:
+            a = Assembler(configfile, info_callback=lambda msg: None)
+            insts = [
+                line
+                for line in a.first_pass(sample_lines(configfile))
+                if not a.plans[line.mnemonic].uses_labels
+            ] * scale
+            a.assemble_instructions(insts, executor)  # warm up the workers
+            times = {}
+            for name, executor_arg in (("serial", None), ("parallel", executor)):
+
+                def run_lines() -> None:
+                    a.encoding_cache.clear()
+                    a.assemble_instructions(insts, executor_arg)
+
+                def run_words() -> None:
+                    a.encoding_cache.clear()
+                    if executor_arg is None:
+                        for pc, line in enumerate(insts):
+                            a.encode_instruction(line, pc)
+                    else:
+                        a.encode_parallel(insts, executor_arg, words_only=True)
+
+                times[name, "lines"] = best_time(run_lines, repeat)
+                times[name, "words"] = best_time(run_words, repeat)
+            print(
+                "{:<16} {:>8}  {:>9.1f}m {:>9.1f}m {:>6.2f}x  {:>9.1f}m {:>9.1f}m {:>6.2f}x".format(
+                    os.path.basename(configfile)[:-5],
+                    len(insts),
+                    times["serial", "lines"] * 1000,
+                    times["parallel", "lines"] * 1000,
+                    times["serial", "lines"] / times["parallel", "lines"],
+                    times["serial", "words"] * 1000,
+                    times["parallel", "words"] * 1000,
+                    times["serial", "words"] / times["parallel", "words"],
+                )
+            )
+    print()
+
+
+def bench_first_pass(configfiles: list[str], scale: int, repeat: int) -> None:
+    """Compare serial and parallel first passes (see Assembler.first_pass())
+    and whole binary-only assemblies (see assemble_words_parallel()).
+
+    The source is each sample's lines, minus instructions using labels
+    (which would overflow their fields), repeated scale times.
+    """
+    print(f"Parallel first pass ({os.cpu_count()} CPUs, best of {repeat})")
+    print(
+        "{:<16} {:>8}  {:>10} {:>10} {:>7}  {:>10} {:>10} {:>7}".format(
+            "ISA", "lines", "first", "parallel", "speedup", "words", "parallel", "speedup"
+        )
+    )
+    with parallel_executor() as executor:
+        for configfile in configfiles:
+            a = Assembler(configfile, info_callback=lambda msg: None)
+            lines = sample_lines(configfile)
+            uses_labels = {
+                line.lineno
+                for line in a.first_pass(lines)
+                if line.mnemonic and a.plans[line.mnemonic].uses_labels
+            }
+            lines = [
+                line for lineno, line in enumerate(lines, 1) if lineno not in uses_labels
+            ] * scale
+            a.assemble_words(lines, executor)  # warm up the workers
+            times = {}
+            for name, executor_arg in (("serial", None), ("parallel", executor)):
+                times[name, "first"] = best_time(
+                    lambda: a.first_pass(lines, executor_arg), repeat
+                )
+                times[name, "words"] = best_time(
+                    lambda: a.assemble_words(lines, executor_arg), repeat
+                )
+            print(
+                "{:<16} {:>8}  {:>9.1f}m {:>9.1f}m {:>6.2f}x  {:>9.1f}m {:>9.1f}m {:>6.2f}x".format(
+                    os.path.basename(configfile)[:-5],
+                    len(lines),
+                    times["serial", "first"] * 1000,
+                    times["parallel", "first"] * 1000,
+                    times["serial", "first"] / times["parallel", "first"],
+                    times["serial", "words"] * 1000,
+                    times["parallel", "words"] * 1000,
+                    times["serial", "words"] / times["parallel", "words"],
+                )
+            )
+    print()
+
+
+def bench_numpy(configfiles: list[str], scale: int, repeat: int) -> None:
+    """Compare the "numpy" backend's assemble_words() with the default
+    "plan" backend's (with its encoding cache), timing just the encoding
+    (after first_pass()) as well as the whole call.
+
+    The source is each sample's lines, minus instructions using labels
+    (which would overflow their fields), repeated scale times.
+    """
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        print("NumPy backend: NumPy not installed, skipping")
+        print()
+        return
+    print(f"NumPy backend (sample x{scale}, best of {repeat})")
+    print(
+        "{:<16} {:>8}  {:>10} {:>10} {:>7}  {:>10} {:>10} {:>7}".format(
+            "ISA", "lines", "encode", "numpy", "speedup", "words", "numpy", "speedup"
+        )
+    )
+    for configfile in configfiles:
+        times = {}
+        for backend in ("plan", "numpy"):
+            a = Assembler(configfile, info_callback=lambda msg: None, backend=backend)
+            lines = sample_lines(configfile)
+            uses_labels = {
+                line.lineno
+                for line in a.first_pass(lines)
+                if line.mnemonic and a.plans[line.mnemonic].uses_labels
+            }
+            lines = [
+                line for lineno, line in enumerate(lines, 1) if lineno not in uses_labels
+            ] * scale
+            insts = a.first_pass(lines)
+
+            def run_encode() -> None:
+                a.encoding_cache.clear()
+                if backend == "numpy":
+                    a.encode_batch(insts)
+                else:
+                    for pc, line in enumerate(insts):
+                        a.encode_instruction(line, pc)
+
+            def run_words() -> None:
+                a.encoding_cache.clear()
+                a.assemble_words(lines)
+
+            times[backend, "encode"] = best_time(run_encode, repeat)
+            times[backend, "words"] = best_time(run_words, repeat)
+        print(
+            "{:<16} {:>8}  {:>9.1f}m {:>9.1f}m {:>6.2f}x  {:>9.1f}m {:>9.1f}m {:>6.2f}x".format(
+                os.path.basename(configfile)[:-5],
+                len(lines),
+                times["plan", "encode"] * 1000,
+                times["numpy", "encode"] * 1000,
+                times["plan", "encode"] / times["numpy", "encode"],
+                times["plan", "words"] * 1000,
+                times["numpy", "words"] * 1000,
+                times["plan", "words"] / times["numpy", "words"],
+            )
+        )
+    print()
+
+
+def bench_listing(configfiles: list[str], scale: int, repeat: int) -> None:
+    """Compare building a listing as a string (prettyprint_assembly()) with
+    streaming it to a file (write_listing()), with the column width found
+    by a first pass or given up front.
+
+    Each sample's instructions are repeated scale times.
+    """
+    print(f"Listing (sample x{scale}, best of {repeat})")
+    print(
+        "{:<16} {:>8}  {:>10} {:>10} {:>10}".format(
+            "ISA", "insts", "string", "stream", "width"
+        )
+    )
+    with open(os.devnull, "w") as out:
+        for configfile in configfiles:
+            a = Assembler(configfile, info_callback=lambda msg: None)
+            instructions = a.assemble_lines(sample_lines(configfile)) * scale
+            width = a.isa.listing_width(instructions)
+            times = [
+                best_time(lambda: out.write(a.prettyprint_assembly(instructions)), repeat),
+                best_time(lambda: a.write_listing(out, instructions), repeat),
+                best_time(lambda: a.write_listing(out, instructions, width=width), repeat),
+            ]
+            print(
+                "{:<16} {:>8}  {:>9.1f}m {:>9.1f}m {:>9.1f}m".format(
+                    os.path.basename(configfile)[:-5],
+                    len(instructions),
+                    *(t * 1000 for t in times),
+                )
+            )
+    print()
+
+
+BENCHMARKS = {
+    "backends": bench_backends,
+    "words": bench_words,
+    "parallel": bench_parallel,
+    "first_pass": bench_first_pass,
+    "numpy": bench_numpy,
+    "listing": bench_listing,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="CS256 ISA Assembler benchmarks")
+    parser.add_argument(
+        "configfiles", nargs="*", help="Assembler config files (default: conf/*.conf)"
+    )
+    parser.add_argument(
+        "--bench",
+        action="append",
+        choices=BENCHMARKS,
+        help="Benchmark to run (may be repeated; default: all)",
+    )
+    parser.add_argument("--scale", type=int, default=1000, help="Sample repetitions")
+    parser.add_argument("--repeat", type=int, default=3, help="Timing repetitions")
+    args = parser.parse_args()
+
+    configfiles = args.configfiles or sorted(glob.glob("conf/*.conf"))
+    for name in args.bench or BENCHMARKS:
+        BENCHMARKS[name](configfiles, args.scale, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
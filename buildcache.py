@@ -0,0 +1,135 @@
+"""
+CS256 ISA Assembler: Build cache
+Author: Mark Liffiton
+
+Keeps the results of assembling a source file (output images, listing, and
+messages), keyed by a hash of everything they depend on, so an identical
+build can skip assembling and leave up-to-date output files untouched.
+"""
+
+import hashlib
+import marshal
+import os
+from dataclasses import dataclass
+from pathlib import PurePath
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from assembler import ISA
+
+# Bump whenever the contents of cached builds change.
+BUILD_CACHE_VERSION = 1
+
+
+@dataclass
+class Build:
+    """The results of assembling one source file."""
+
+    count: int  # number of instructions
+    messages: list[tuple[str, str]]  # reported while assembling
+    listing: str | None
+    outputs: list[bytes]  # contents of each output file
+
+
+class BuildCache:
+    """A directory of cached builds, holding at most max_entries of them
+    (evicting the least recently used)."""
+
+    def __init__(self, directory: str, max_entries: int = 256) -> None:
+        self.directory = directory
+        self.max_entries = max_entries
+
+    @classmethod
+    def for_config(cls, configfile: str, max_entries: int = 256) -> "BuildCache":
+        """The cache for builds with a config file: in $ASM256_CACHE_DIR if
+        set, else __pycache__ beside it (as for parsed configs)."""
+        cachedir = os.environ.get("ASM256_CACHE_DIR") or os.path.join(
+            PurePath(configfile).parent, "__pycache__"
+        )
+        return cls(os.path.join(cachedir, "builds"), max_entries)
+
+    @staticmethod
+    def key(source: bytes, isa: "ISA", format: str, listing: bool) -> str:
+        """The key for a build: a hash of the source, the config's contents,
+        any value swaps, the output format, and whether it has a listing."""
+        h = hashlib.sha256()
+        for part in (BUILD_CACHE_VERSION, isa.config_hash, isa.swaps, format, listing):
+            h.update(repr(part).encode())
+            h.update(b"\0")
+        h.update(source)
+        return h.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".build")
+
+    def get(self, key: str) -> Build | None:
+        """Return the cached build for key, if any."""
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = marshal.load(f)
+            if data.get("version") != BUILD_CACHE_VERSION:
+                return None
+            build = Build(data["count"], data["messages"], data["listing"], data["outputs"])
+            os.utime(path)  # mark it as recently used
+        except (OSError, EOFError, ValueError, TypeError, KeyError, AttributeError):
+            return None  # missing or unreadable
+        return build
+
+    def put(self, key: str, build: Build) -> None:
+        """Cache a build, evicting the least recently used if full."""
+        data = {
+            "version": BUILD_CACHE_VERSION,
+            "count": build.count,
+            "messages": build.messages,
+            "listing": build.listing,
+            "outputs": build.outputs,
+        }
+        path = self.path(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmpfile = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmpfile, "wb") as f:
+                marshal.dump(data, f)
+            os.replace(tmpfile, path)
+            self.evict()
+        except OSError:
+            pass  # e.g., read-only directory: just don't cache
+
+    def evict(self) -> None:
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".build"):
+                try:
+                    entries.append((entry.stat().st_mtime_ns, entry.path))
+                except OSError:
+                    pass  # removed by another process
+        entries.sort()
+        for _, path in entries[: max(0, len(entries) - self.max_entries)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def read_outputs(outfiles: list[str]) -> list[bytes]:
+    outputs = []
+    for filename in outfiles:
+        with open(filename, "rb") as f:
+            outputs.append(f.read())
+    return outputs
+
+
+def restore_outputs(outfiles: list[str], outputs: list[bytes]) -> None:
+    """Write output files, leaving any that already hold the right contents
+    untouched (so their modification times are kept)."""
+    for filename, data in zip(outfiles, outputs):
+        try:
+            if os.path.getsize(filename) == len(data):
+                with open(filename, "rb") as f:
+                    if f.read() == data:
+                        continue
+        except OSError:
+            pass  # missing: write it
+        with open(filename, "wb") as f:
+            f.write(data)
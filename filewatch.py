@@ -0,0 +1,134 @@
+"""
+CS256 ISA Assembler: File watcher
+Author: Mark Liffiton
+
+Waits for files to change, with inotify on Linux (via ctypes, so no extra
+dependencies) and by polling their status elsewhere.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from collections.abc import Iterable
+
+# from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+# Further events arriving within this many seconds of a change (e.g., an
+# editor writing a backup, then renaming it over the file) count as part of it
+SETTLE_TIME = 0.005
+
+
+class FileWatcher:
+    """Watches a set of files for changes: a file being written, replaced
+    (e.g., an editor saving to a new file and renaming it), or created.
+
+    The directories containing the files are watched rather than the files
+    themselves, so a file replaced by a rename is still watched afterwards.
+    """
+
+    def __init__(self, paths: Iterable[str], poll_interval: float = 0.1) -> None:
+        self.paths = {os.path.abspath(path) for path in paths}
+        self.poll_interval = poll_interval
+        self.fd: int | None = None
+        self.dirs: dict[int, str] = {}  # inotify watch descriptor -> directory
+        try:
+            self.start_inotify()
+        except OSError:
+            self.close()
+        self.stats = {path: self.stat(path) for path in self.paths}
+
+    @property
+    def method(self) -> str:
+        return "inotify" if self.fd is not None else "polling"
+
+    def start_inotify(self) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        try:
+            inotify_init1 = libc.inotify_init1
+            inotify_add_watch = libc.inotify_add_watch
+        except AttributeError:
+            raise OSError("inotify not available")
+        inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.fd = inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            self.fd = None
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        for dir in {os.path.dirname(path) for path in self.paths}:
+            wd = inotify_add_watch(
+                self.fd, os.fsencode(dir), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+            )
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_add_watch", dir)
+            self.dirs[wd] = dir
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.dirs = {}
+
+    @staticmethod
+    def stat(path: str) -> tuple[int, int, int] | None:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def wait(self) -> set[str]:
+        """Block until any of the files change, returning the paths of
+        those that did."""
+        if self.fd is None:
+            return self.poll()
+
+        changed: set[str] = set()
+        timeout = None  # wait indefinitely for the first change
+        while True:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if not ready:
+                if changed:
+                    return changed
+                continue
+            changed |= self.read_events()
+            if changed:
+                timeout = SETTLE_TIME
+
+    def read_events(self) -> set[str]:
+        assert self.fd is not None
+        data = os.read(self.fd, 65536)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                return set(self.paths)  # events lost: assume everything changed
+            path = os.path.join(self.dirs.get(wd, ""), os.fsdecode(name))
+            if path in self.paths:
+                changed.add(path)
+        return changed
+
+    def poll(self) -> set[str]:
+        while True:
+            changed = set()
+            for path in self.paths:
+                stat = self.stat(path)
+                if stat != self.stats[path]:
+                    self.stats[path] = stat
+                    changed.add(path)
+            if changed:
+                return changed
+            time.sleep(self.poll_interval)
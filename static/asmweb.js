@@ -1,47 +1,104 @@
 var cm = null;
 var cur_mark = null;
+var cur_etag = null;
 
-function submitasm() {
-    $.post('/assemble/', cm.getValue(), function(data) {
-        if (data['messages'].length) {
-            $('#info').show().removeClass('hide');
-            $('#info').empty();
-            data['messages'].forEach(function(msg) {
-                newinfo = $("<div>", {class: 'alert alert-info'});
-                newinfo.append($('<strong>', {text: msg[0] + ":"}));
-                newinfo.append(' ' + msg[1]);
-                $('#info').append(newinfo);
-            });
-        }
-        else {
-            $('#info').hide();
-        }
+// Recent results by ETag.  Their ETags are sent with each submission, so if
+// the code is one of them again (e.g., after an undo), the server answers 304
+// Not Modified and the result is shown from here.
+var results = {};
+var result_etags = [];
+var MAX_RESULTS = 16;
 
-        if (data['error']) {
-            var err = data['error'];
-            var newerror = $("<div>").append($('<strong>', {text: err['msg'] + ":"}));
-            newerror.append(' ' + err['data']);
-            newerror.append('<br><strong>Line ' + err['lineno'] + ': </strong>' + err['inst']);
-            cur_mark = cm.markText(
-                {line:err['lineno']-1, ch:0},
-                {line:err['lineno'], ch:0},
-                {className: 'cm-error'}
-            );
-            $('#error').html(newerror);
-            $('#error').show().removeClass('hide');
-            $('#machine_code_panel').addClass("dim");
-        }
-        else {
-            $('#machine_code').html(data['code']);
-            $('#upper').html(data['upper']);
-            $('#lower').html(data['lower']);
-            $('#bin').html(data['bin']);
-            $('#machine_code_panel').removeClass("dim");
-            $('#error').hide();
+function submitasm() {
+    var headers = {};
+    if (result_etags.length) {
+        headers['If-None-Match'] = result_etags.join(', ');
+    }
+    $.ajax({
+        url: '/assemble/',
+        type: 'POST',
+        data: cm.getValue(),
+        headers: headers,
+        success: function(data, textStatus, xhr) {
+            var etag = xhr.getResponseHeader('ETag');
+            if (xhr.status == 304) {
+                data = results[etag];
+                if (!data) {
+                    return;
+                }
+                result_etags.splice(result_etags.indexOf(etag), 1);
+                result_etags.push(etag);
+            }
+            else if (etag) {
+                addresult(etag, data);
+            }
+            if (xhr.status == 304 && etag == cur_etag) {
+                // Already showing this result; just restore its error mark.
+                markerror(data['error']);
+            }
+            else {
+                showresult(data);
+            }
+            cur_etag = etag;
         }
     });
 }
 
+function addresult(etag, data) {
+    if (!(etag in results)) {
+        result_etags.push(etag);
+    }
+    results[etag] = data;
+    while (result_etags.length > MAX_RESULTS) {
+        delete results[result_etags.shift()];
+    }
+}
+
+function markerror(err) {
+    if (err) {
+        cur_mark = cm.markText(
+            {line:err['lineno']-1, ch:0},
+            {line:err['lineno'], ch:0},
+            {className: 'cm-error'}
+        );
+    }
+}
+
+function showresult(data) {
+    if (data['messages'].length) {
+        $('#info').show().removeClass('hide');
+        $('#info').empty();
+        data['messages'].forEach(function(msg) {
+            newinfo = $("<div>", {class: 'alert alert-info'});
+            newinfo.append($('<strong>', {text: msg[0] + ":"}));
+            newinfo.append(' ' + msg[1]);
+            $('#info').append(newinfo);
+        });
+    }
+    else {
+        $('#info').hide();
+    }
+
+    if (data['error']) {
+        var err = data['error'];
+        var newerror = $("<div>").append($('<strong>', {text: err['msg'] + ":"}));
+        newerror.append(' ' + err['data']);
+        newerror.append('<br><strong>Line ' + err['lineno'] + ': </strong>' + err['inst']);
+        markerror(err);
+        $('#error').html(newerror);
+        $('#error').show().removeClass('hide');
+        $('#machine_code_panel').addClass("dim");
+    }
+    else {
+        $('#machine_code').html(data['code']);
+        $('#upper').html(data['upper']);
+        $('#lower').html(data['lower']);
+        $('#bin').html(data['bin']);
+        $('#machine_code_panel').removeClass("dim");
+        $('#error').hide();
+    }
+}
+
 function getsaves() {
     if (localStorage.getItem('saves') === null) {
         return {};
@@ -0,0 +1,11 @@
+"""
+CS256 ISA Assembler: Test configuration
+Author: Mark Liffiton
+"""
+
+import os
+import sys
+
+# The modules under test live at the top of the repository.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
@@ -0,0 +1,71 @@
+"""
+CS256 ISA Assembler: Tests of the on-disk ISA cache
+Author: Mark Liffiton
+"""
+
+import hashlib
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+
+import assembler
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture
+def cachedir(tmp_path, monkeypatch):
+    """One cache directory shared by every config."""
+    path = tmp_path / "cache"
+    monkeypatch.setenv("ASM256_CACHE_DIR", str(path))
+    return path
+
+
+@pytest.fixture
+def configs(tmp_path):
+    """Two different configs with the same name, in different directories."""
+    a = tmp_path / "a" / "isa.conf"
+    b = tmp_path / "b" / "isa.conf"
+    for src, dest in (("S16_DYEL.conf", a), ("S17_SAM.conf", b)):
+        dest.parent.mkdir()
+        shutil.copy(ROOT / "conf" / src, dest)
+    return a, b
+
+
+def cache_entry(configfile):
+    digest = hashlib.sha256(configfile.read_bytes()).hexdigest()
+    return os.path.basename(assembler.isa_cache_file(configfile, digest))
+
+
+def test_same_name_configs_cached_separately(cachedir, configs, monkeypatch):
+    expected = [assembler.parse_config(path.read_text()) for path in configs]
+    for path in configs:
+        assembler.load_config(path)
+    assert sorted(os.listdir(cachedir)) == sorted(cache_entry(path) for path in configs)
+
+    def parse_config(text):
+        raise AssertionError("parsed instead of loaded from the cache")
+
+    monkeypatch.setattr(assembler, "parse_config", parse_config)
+    for path, data in zip(configs, expected):
+        loaded = assembler.load_config(path)
+        del loaded["version"], loaded["hash"]
+        assert loaded == data
+
+
+def test_edited_config_replaces_only_its_own_entries(cachedir, configs):
+    a, b = configs
+    for path in configs:
+        assembler.load_config(path)
+    # entries in the old format (stem.digest.isa), for this name and another
+    (cachedir / "isa.0123456789abcdef.isa").write_bytes(b"")
+    (cachedir / "other.0123456789abcdef.isa").write_bytes(b"")
+
+    a.write_text(a.read_text() + "\n# edited\n")
+    assembler.load_config(a)
+
+    assert sorted(os.listdir(cachedir)) == sorted(
+        [cache_entry(a), cache_entry(b), "other.0123456789abcdef.isa"]
+    )
@@ -0,0 +1,90 @@
+"""
+CS256 ISA Assembler: Tests of parallel assembly
+Author: Mark Liffiton
+
+Assembling with an executor must give exactly what assembling serially
+does: the same words, listing, labels, and messages, or the same error.
+"""
+
+import glob
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+
+import assembler
+from assembler import ISA, Assembler, AssemblerException
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIGS = sorted(glob.glob(os.path.join(ROOT, "conf", "*.conf")))
+
+
+@pytest.fixture(scope="module", params=["thread", "process"])
+def executor(request):
+    pool = ThreadPoolExecutor(3) if request.param == "thread" else ProcessPoolExecutor(2)
+    with pool:
+        yield pool
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    # so the samples below are split into several chunks
+    monkeypatch.setattr(assembler, "PARALLEL_MIN_CHUNK", 64)
+
+
+def program(configfile: str, variant: int) -> list[str]:
+    """A config's sample repeated, with a few lines replaced by bad ones
+    (invalid lines, bad operands, duplicate labels, commas, etc.)."""
+    with open(ISA.from_file(configfile).samplefile) as f:
+        base = f.readlines() * 20
+    labels = [line for line in base if line.strip().endswith(":")] or ["x:\n"]
+    rand = random.Random(variant)
+    lines = list(base)
+    for _ in range(variant % 3):
+        i = rand.randrange(len(lines))
+        lines[i] = rand.choice(
+            [
+                rand.choice(labels),
+                "junk\n",
+                "add $1 $99\n",
+                "beq $1 nowhere\n",
+                lines[i].replace(" ", ", ", 1),
+                lines[i].replace("$", "x"),
+            ]
+        )
+    if variant == 3:
+        i = rand.randrange(len(lines))
+        lines[i] = lines[i].replace(" ", ", ", 1)
+    return lines
+
+
+def run(configfile, lines, executor, words, backend):
+    """Everything observable about assembling lines."""
+    messages = []
+    a = Assembler(configfile, info_callback=messages.append, backend=backend)
+    try:
+        if words:
+            return ("words", a.assemble_words(lines, executor), a.labels, messages)
+        instructions = a.assemble_lines(lines, executor)
+        return (
+            "lines",
+            [inst.binary for inst in instructions],
+            [inst.line.text for inst in instructions],
+            a.prettyprint_assembly(instructions, colorize=True),
+            a.report_commas,
+            a.labels,
+            messages,
+        )
+    except AssemblerException as e:
+        return ("error", str(e), e.lineno, messages)
+
+
+@pytest.mark.parametrize("configfile", CONFIGS, ids=os.path.basename)
+@pytest.mark.parametrize("variant", range(4))
+@pytest.mark.parametrize("words", [False, True], ids=["lines", "words"])
+def test_parallel_matches_serial(executor, configfile, variant, words):
+    lines = program(configfile, variant)
+    backend = ("plan", "codegen")[variant % 2]
+    serial = run(configfile, lines, None, words, backend)
+    assert run(configfile, lines, executor, words, backend) == serial
@@ -0,0 +1,153 @@
+"""
+CS256 ISA Assembler: Tests of the web servers' request handling
+Author: Mark Liffiton
+
+Each server runs asmweb.py in a subprocess; requests are written to a raw
+socket so malformed ones reach the server as sent.
+"""
+
+import re
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+SAMPLE = (ROOT / "conf" / "S16_DYEL_sample.asm").read_bytes()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def serve():
+    """Start asmweb.py with the given --server (and AsyncServer keep-alive
+    timeout), returning its port once it accepts connections."""
+    procs = []
+
+    def start(server: str, keepalive_timeout: float | None = None) -> int:
+        port = free_port()
+        code = (
+            "import sys, webserver\n"
+            "if {timeout!r} is not None:\n"
+            "    webserver.AsyncServer.keepalive_timeout = {timeout!r}\n"
+            "sys.argv = ['asmweb.py', 'conf/S16_DYEL.conf', '{port}', '--server', '{server}']\n"
+            "import asmweb\n"
+            "asmweb.main()\n"
+        ).format(timeout=keepalive_timeout, port=port, server=server)
+        proc = subprocess.Popen(
+            [sys.executable, "-c", code],
+            cwd=ROOT,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        procs.append(proc)
+        for _ in range(200):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                return port
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError("server did not start")
+
+    yield start
+
+    for proc in procs:
+        proc.terminate()
+        proc.wait()
+        assert b"Traceback" not in proc.stderr.read()
+
+
+def send(port: int, data: bytes, wait: float = 1.0) -> tuple[list[bytes], bool]:
+    """The status lines of every response to data, and whether the server
+    left the connection open."""
+    with socket.create_connection(("127.0.0.1", port)) as s:
+        s.sendall(data)
+        s.settimeout(wait)
+        out = b""
+        try:
+            while chunk := s.recv(65536):
+                out += chunk
+            still_open = False
+        except socket.timeout:
+            still_open = True
+    return re.findall(rb"HTTP/1\.[01] (\d{3})", out), still_open
+
+
+def post(path: bytes, body: bytes, headers: bytes = b"") -> bytes:
+    return (
+        b"POST %s HTTP/1.1\r\nHost: x\r\nContent-Length: %d\r\n%s\r\n"
+        % (path, len(body), headers)
+        + body
+    )
+
+
+# threaded server (keep-alive)
+
+
+def test_keepalive_requests(serve):
+    port = serve("threaded")
+    assert send(port, post(b"/assemble/", SAMPLE) * 2) == ([b"200", b"200"], True)
+
+
+def test_unread_body_is_not_a_request(serve):
+    port = serve("threaded")
+    inner = b"GET / HTTP/1.1\r\nHost: x\r\n\r\n"
+    assert send(port, post(b"/static/asmweb.css", inner)) == ([b"405"], True)
+
+
+def test_body_then_next_request(serve):
+    port = serve("threaded")
+    data = post(b"/static/asmweb.css", b"abc") + b"GET / HTTP/1.1\r\n\r\n"
+    assert send(port, data) == ([b"405", b"200"], True)
+
+
+@pytest.mark.parametrize("length", [b"x", b"-3"])
+def test_threaded_bad_content_length(serve, length):
+    port = serve("threaded")
+    data = b"POST /assemble/ HTTP/1.1\r\nContent-Length: %s\r\n\r\n" % length
+    assert send(port, data) == ([b"400"], False)
+
+
+def test_transfer_encoding_closes_connection(serve):
+    port = serve("threaded")
+    data = (
+        b"POST /static/asmweb.css HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n"
+        b"0\r\n\r\nGET / HTTP/1.1\r\n\r\n"
+    )
+    assert send(port, data) == ([b"405"], False)
+
+
+# async server
+
+
+@pytest.mark.parametrize(
+    "data, status",
+    [
+        (b"GET /" + b"a" * 70000 + b" HTTP/1.1\r\n\r\n", b"414"),
+        (b"GET / HTTP/1.1\r\nX-Big: " + b"a" * 70000 + b"\r\n\r\n", b"400"),
+        (b"POST /assemble/ HTTP/1.1\r\nContent-Length: abc\r\n\r\n", b"400"),
+        (b"POST /assemble/ HTTP/1.1\r\nContent-Length: -1\r\n\r\n", b"400"),
+    ],
+    ids=["long-line", "long-header", "bad-length", "negative-length"],
+)
+def test_async_malformed_request(serve, data, status):
+    port = serve("async")
+    assert send(port, data, wait=5) == ([status], False)
+
+
+def test_async_keepalive_requests(serve):
+    port = serve("async")
+    assert send(port, post(b"/assemble/", SAMPLE) * 2) == ([b"200", b"200"], True)
+
+
+def test_async_body_timeout(serve):
+    port = serve("async", keepalive_timeout=0.5)
+    data = b"POST /assemble/ HTTP/1.1\r\nContent-Length: 1000\r\n\r\nabc"
+    assert send(port, data, wait=5) == ([b"408"], False)
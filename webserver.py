@@ -0,0 +1,606 @@
+"""
+CS256 ISA Assembler: Web servers
+Author: Mark Liffiton
+
+Server backends for asmweb.py beyond those built into Bottle.
+"""
+
+import asyncio
+import gc
+import io
+import os
+import signal
+import socket
+import sys
+import traceback
+from collections.abc import Callable, Iterator
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from email.utils import formatdate
+from http import HTTPStatus
+from typing import Any
+from urllib.parse import unquote
+from socketserver import ThreadingMixIn
+from wsgiref.headers import Headers
+from wsgiref.simple_server import ServerHandler, WSGIRequestHandler, WSGIServer
+
+from bottle import ServerAdapter, WSGIRefServer
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """wsgiref's server, handling each connection in its own thread."""
+
+    daemon_threads = True
+    request_queue_size = 128  # (socketserver's 5 drops a lab's worth of connects)
+
+
+class KeepAliveServerHandler(ServerHandler):
+    http_version = "1.1"
+    # whether the response's end can be found without closing the connection
+    keep_alive = False
+
+    # (set by start_response(), and by KeepAliveHandler, as in wsgiref)
+    headers: Headers | None
+    request_handler: WSGIRequestHandler
+
+    def close(self) -> None:
+        self.keep_alive = self.headers is not None and "Content-Length" in self.headers
+        super().close()
+
+
+class RequestBody:
+    """A request's body, read from its connection's input but limited to
+    its Content-Length, so that reading stops where the next request
+    begins."""
+
+    max_drain = 1 << 20  # largest unread rest worth reading to keep a connection
+
+    def __init__(self, rfile: io.BufferedIOBase, length: int) -> None:
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.readline(size)
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint: int = -1) -> list[bytes]:
+        lines = []
+        total = 0
+        while line := self.readline():
+            lines.append(line)
+            total += len(line)
+            if 0 < hint <= total:
+                break
+        return lines
+
+    def __iter__(self) -> Iterator[bytes]:
+        while line := self.readline():
+            yield line
+
+    def drain(self) -> bool:
+        """Read and discard whatever the app left unread, returning whether
+        the connection is then at the start of the next request."""
+        if self.remaining > self.max_drain:
+            return False
+        try:
+            while self.remaining and self.read(65536):
+                pass
+        except OSError:  # (e.g., timed out)
+            return False
+        return not self.remaining
+
+
+class KeepAliveHandler(WSGIRequestHandler):
+    """wsgiref's request handler, but serving any number of requests on an
+    HTTP/1.1 connection (wsgiref handles just one per connection).
+
+    A response without a Content-Length ends its connection, as does a
+    connection left idle for timeout seconds or a request whose body's end
+    cannot be found (a Transfer-Encoding, or too much left unread to skip).
+    """
+
+    protocol_version = "HTTP/1.1"
+    timeout = 30
+
+    server: WSGIServer
+
+    def address_string(self) -> str:
+        return self.client_address[0]  # no reverse DNS lookups
+
+    def handle(self) -> None:
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self) -> None:
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except TimeoutError:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ""
+            self.request_version = ""
+            self.command = ""
+            self.send_error(414)
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if not self.parse_request():  # (sets close_connection from the headers)
+            return
+        if self.request_version != "HTTP/1.1":
+            self.close_connection = True  # (no keep-alive for HTTP/1.0)
+
+        # Limit the app to this request's body, and skip any of it left
+        # unread afterward, so it can never be taken for another request.
+        body: RequestBody | None = None
+        if "Transfer-Encoding" in self.headers:
+            self.close_connection = True  # (the body's end is up to the app)
+        else:
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+            except ValueError:
+                length = -1
+            if length < 0:
+                self.send_error(400, "Bad Content-Length")
+                return
+            body = RequestBody(self.rfile, length)
+
+        handler = KeepAliveServerHandler(
+            body or self.rfile,
+            self.wfile,  # type: ignore[arg-type]  # (as passed by wsgiref)
+            self.get_stderr(),
+            self.get_environ(),
+        )
+        handler.request_handler = self  # backpointer for logging
+        app = self.server.get_app()
+        assert app is not None
+        handler.run(app)
+        if not handler.keep_alive or body is None or not body.drain():
+            self.close_connection = True
+        self.wfile.flush()
+
+
+class ThreadedServer(WSGIRefServer):
+    """Bottle's wsgiref server backend, with a thread per connection and
+    HTTP/1.1 keep-alive."""
+
+    def run(self, app) -> None:  # type: ignore[no-untyped-def]
+        self.options.setdefault("server_class", ThreadingWSGIServer)
+        self.options.setdefault("handler_class", KeepAliveHandler)
+        super().run(app)
+
+
+class WorkerWSGIServer(WSGIServer):
+    """wsgiref's server for a pre-forked worker: serves requests one at a
+    time from an already listening socket, counting them."""
+
+    timeout = 1.0  # how often to check whether to stop while idle
+
+    def __init__(self, sock: socket.socket) -> None:
+        host, port = sock.getsockname()[:2]
+        super().__init__((host, port), WorkerRequestHandler, False)
+        self.socket.close()
+        self.socket = sock
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+        self.requests = 0
+        self.quiet = False  # (no request logging)
+
+    def finish_request(self, request, client_address) -> None:  # type: ignore[no-untyped-def]
+        super().finish_request(request, client_address)
+        self.requests += 1
+
+
+class WorkerRequestHandler(WSGIRequestHandler):
+    timeout = 30  # so a stalled client cannot hold up a worker for long
+    server: WorkerWSGIServer
+
+    def address_string(self) -> str:
+        return self.client_address[0]  # no reverse DNS lookups
+
+    def log_request(self, *args, **kwargs) -> None:  # type: ignore[no-untyped-def]
+        if not self.server.quiet:
+            super().log_request(*args, **kwargs)
+
+
+class PreforkServer(ServerAdapter):
+    """A master process forking workers that each serve requests one at a
+    time from a shared listening socket.
+
+    Everything loaded before run() (e.g., the ISA and its compiled tables and
+    regexes) is frozen out of the garbage collector's reach (gc.freeze()),
+    so workers share it copy-on-write.  Options:
+
+      workers: number of worker processes (default: CPU count)
+      max_requests: recycle (replace) a worker after this many requests
+                    (default: 0, never)
+      reload: called in the master on SIGHUP (e.g., to reload the config)
+              before it gracefully restarts the workers: new ones are forked
+              and the old ones finish their current request and exit
+
+    SIGTERM or SIGINT stops the master and all workers.
+    """
+
+    def run(self, app) -> None:  # type: ignore[no-untyped-def]
+        self.app = app
+        self.num_workers: int = self.options.get("workers") or os.cpu_count() or 1
+        self.max_requests: int = self.options.get("max_requests", 0)
+        self.reload: Callable[[], None] | None = self.options.get("reload")
+
+        family = socket.AF_INET6 if ":" in self.host else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            # let a restarted master bind while old workers are still draining
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(128)
+        # workers race to accept; the losers must not block in accept()
+        self.sock.setblocking(False)
+
+        signals = {signal.SIGCHLD, signal.SIGHUP, signal.SIGTERM, signal.SIGINT}
+        signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+        self.workers: dict[int, int] = {}  # pid -> generation
+        generation = 0
+        try:
+            while True:
+                self.spawn(generation)
+                info = signal.sigtimedwait(signals, 1.0)
+                self.reap()
+                if info is None or info.si_signo == signal.SIGCHLD:
+                    continue
+                if info.si_signo == signal.SIGHUP:
+                    if self.reload:
+                        try:
+                            self.reload()
+                        except Exception:
+                            traceback.print_exc()  # keep the current workers
+                            continue
+                    generation += 1
+                    self.spawn(generation)
+                    self.stop(
+                        pid for pid, gen in self.workers.items() if gen < generation
+                    )
+                else:
+                    break
+        finally:
+            self.stop(list(self.workers))
+            while self.workers:
+                pid, _ = os.wait()
+                self.workers.pop(pid, None)
+            self.sock.close()
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+
+    def spawn(self, generation: int) -> None:
+        """Fork workers until there are enough of the given generation."""
+        current = sum(gen == generation for gen in self.workers.values())
+        if current < self.num_workers:
+            gc.freeze()  # share everything loaded so far
+        for _ in range(self.num_workers - current):
+            pid = os.fork()
+            if pid == 0:
+                status = 0
+                try:
+                    self.serve()
+                except BaseException:
+                    traceback.print_exc()
+                    status = 1
+                finally:
+                    os._exit(status)
+            self.workers[pid] = generation
+
+    def reap(self) -> None:
+        while self.workers:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            self.workers.pop(pid, None)
+
+    def stop(self, pids) -> None:  # type: ignore[no-untyped-def]
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def serve(self) -> None:
+        """Serve requests in a worker until stopped or recycled."""
+        stopping = False
+
+        def stop(signum, frame) -> None:  # type: ignore[no-untyped-def]
+            nonlocal stopping
+            stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # (the master stops us)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.pthread_sigmask(
+            signal.SIG_UNBLOCK,
+            {signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD},
+        )
+
+        server = WorkerWSGIServer(self.sock)
+        server.set_app(self.app)
+        server.quiet = self.quiet
+        while not stopping and not (
+            self.max_requests and server.requests >= self.max_requests
+        ):
+            server.handle_request()
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+# A handler run in AsyncServer's executor: (request body, query string,
+# request headers with lowercase names) -> (status, response headers, response
+# body).  It must be picklable for a process executor.
+OffloadHandler = Callable[
+    [bytes, str, dict[str, str]], tuple[int, list[tuple[str, str]], bytes]
+]
+
+
+class AsyncServer(ServerAdapter):
+    """An asyncio HTTP/1.1 server, with keep-alive.
+
+    Each connection is just a coroutine while idle or while its request is
+    being read, so slow clients do not hold up others and idle keep-alive
+    connections are cheap.  Requests for the routes given in offload are
+    run in a bounded executor, and answered with 503 (Service Unavailable)
+    while it has queue requests waiting; all others are passed to the WSGI
+    app in a thread.  Options:
+
+      offload: {(method, path): handler} (see OffloadHandler)
+      executor: "thread" or "process" (default: "thread")
+      workers: size of the executor (default: CPU count)
+      queue: requests allowed to wait for the executor (default: 64)
+      initializer, initargs: run in each process of a process executor
+    """
+
+    keepalive_timeout = 60  # seconds an idle connection is kept open
+    max_body = 1 << 20
+
+    def run(self, app) -> None:  # type: ignore[no-untyped-def]
+        self.app = app
+        self.offload: dict[tuple[str, str], OffloadHandler] = self.options.get(
+            "offload", {}
+        )
+        workers = self.options.get("workers") or os.cpu_count() or 1
+        self.limit = workers + self.options.get("queue", 64)
+        self.pending = 0
+        self.executor: Executor
+        if self.options.get("executor", "thread") == "process":
+            self.executor = ProcessPoolExecutor(
+                workers,
+                initializer=self.options.get("initializer"),
+                initargs=self.options.get("initargs", ()),
+            )
+            # start the processes now, before there are threads or a listening
+            # socket for them to inherit
+            self.executor.submit(int).result()
+        else:
+            self.executor = ThreadPoolExecutor(workers)
+        try:
+            asyncio.run(self.serve())
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+
+    async def serve(self) -> None:
+        server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port, backlog=1024
+        )
+        # stop on SIGTERM, too, so the executor is shut down
+        task = asyncio.current_task()
+        assert task is not None
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while await self.handle_request(reader, writer):
+                pass
+        except asyncio.IncompleteReadError:
+            pass  # client went away mid-request
+        except (ConnectionError, asyncio.TimeoutError):
+            pass  # reset, or idle too long
+        finally:
+            writer.close()
+
+    async def handle_request(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> bool:
+        """Read a request and write its response, returning whether to keep
+        the connection open for another."""
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.keepalive_timeout)
+        except ValueError:  # (longer than the reader's limit, 64 KiB)
+            await self.respond(writer, HTTPStatus.REQUEST_URI_TOO_LONG, keep_alive=False)
+            return False
+        if not line.strip():
+            return False
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError:
+            await self.respond(writer, HTTPStatus.BAD_REQUEST, keep_alive=False)
+            return False
+
+        try:
+            headers = await asyncio.wait_for(
+                self.read_headers(reader), self.keepalive_timeout
+            )
+        except ValueError:  # (a header line longer than the reader's limit)
+            await self.respond(writer, HTTPStatus.BAD_REQUEST, keep_alive=False)
+            return False
+
+        keep_alive = (
+            version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        )
+        if "transfer-encoding" in headers:
+            await self.respond(writer, HTTPStatus.LENGTH_REQUIRED, keep_alive=False)
+            return False
+        try:
+            length = int(headers.get("content-length", 0) or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            await self.respond(writer, HTTPStatus.BAD_REQUEST, keep_alive=False)
+            return False
+        if length > self.max_body:
+            await self.respond(
+                writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, keep_alive=False
+            )
+            return False
+        if length and headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        try:
+            body = await asyncio.wait_for(
+                reader.readexactly(length), self.keepalive_timeout
+            )
+        except asyncio.TimeoutError:
+            await self.respond(writer, HTTPStatus.REQUEST_TIMEOUT, keep_alive=False)
+            return False
+
+        path, _, query = target.partition("?")
+        handler = self.offload.get((method, path))
+        if handler is not None:
+            if self.pending >= self.limit:
+                await self.respond(
+                    writer,
+                    HTTPStatus.SERVICE_UNAVAILABLE,
+                    [("Retry-After", "1")],
+                    keep_alive=keep_alive,
+                )
+                return keep_alive
+            self.pending += 1
+            try:
+                loop = asyncio.get_running_loop()
+                code, response_headers, content = await loop.run_in_executor(
+                    self.executor, handler, body, query, headers
+                )
+            except Exception:
+                traceback.print_exc()
+                await self.respond(
+                    writer, HTTPStatus.INTERNAL_SERVER_ERROR, keep_alive=keep_alive
+                )
+                return keep_alive
+            finally:
+                self.pending -= 1
+            await self.respond(
+                writer, HTTPStatus(code), response_headers, content, keep_alive
+            )
+            return keep_alive
+
+        status, response_headers, content = await asyncio.to_thread(
+            self.call_app, method, path, query, version, headers, body, writer
+        )
+        await self.respond(
+            writer, status, response_headers, content, keep_alive, method == "HEAD"
+        )
+        return keep_alive
+
+    @staticmethod
+    async def read_headers(reader: asyncio.StreamReader) -> dict[str, str]:
+        """Read a request's header lines, up to the blank line ending them."""
+        headers: dict[str, str] = {}
+        while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return headers
+
+    def call_app(
+        self,
+        method: str,
+        path: str,
+        query: str,
+        version: str,
+        headers: dict[str, str],
+        body: bytes,
+        writer: asyncio.StreamWriter,
+    ) -> tuple[str, list[tuple[str, str]], bytes]:
+        """Call the WSGI app for a request, returning its status, headers,
+        and body."""
+        peer = writer.get_extra_info("peername") or ("", 0)
+        environ: dict[str, Any] = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote(path, "latin-1"),
+            "QUERY_STRING": query,
+            "CONTENT_TYPE": headers.get("content-type", ""),
+            "CONTENT_LENGTH": str(len(body)),
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": peer[0],
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        for name, value in headers.items():
+            if name not in ("content-type", "content-length"):
+                environ["HTTP_" + name.upper().replace("-", "_")] = value
+
+        response: list[Any] = []
+
+        def start_response(status, response_headers, exc_info=None):  # type: ignore[no-untyped-def]
+            response[:] = [status, response_headers]
+
+        result = self.app(environ, start_response)
+        try:
+            content = b"".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        status, response_headers = response
+        response_headers = [
+            (name, value)
+            for name, value in response_headers
+            if name.lower() != "content-length"  # (set by respond())
+        ]
+        return status, response_headers, content
+
+    async def respond(
+        self,
+        writer: asyncio.StreamWriter,
+        status: "HTTPStatus | str",
+        headers: list[tuple[str, str]] | None = None,
+        content: bytes = b"",
+        keep_alive: bool = True,
+        head: bool = False,
+    ) -> None:
+        if isinstance(status, HTTPStatus):
+            status = "{} {}".format(status.value, status.phrase)
+        lines = ["HTTP/1.1 " + status, "Date: " + formatdate(usegmt=True)]
+        lines += ["{}: {}".format(name, value) for name, value in headers or []]
+        if status[:3] not in ("204", "304"):  # (never have a body)
+            lines.append("Content-Length: {}".format(len(content)))
+        if not keep_alive:
+            lines.append("Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if not head:
+            writer.write(content)
+        await writer.drain()
+
+
+# Backends by name, in addition to Bottle's (bottle.server_names)
+SERVERS = {"threaded": ThreadedServer, "prefork": PreforkServer, "async": AsyncServer}